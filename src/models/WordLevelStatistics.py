@@ -1,7 +1,478 @@
 # -*- coding: utf-8 -*-
 
 import re
-from scipy import stats
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .position_index import (PositionIndex, PositionIndexBuilder,
+                             TokenSequence, load_index, save_index)
+
+
+# Python's float ** goes through the C library pow(), which does not always
+# round like np.power or np.sqrt. Used where the result has to match the
+# per word computation in compute_spectrum exactly.
+_float_pow = np.frompyfunc(pow, 2, 1)
+
+RE_WORD = re.compile(r'\w+')
+
+
+def _power(x, y, exact=True):
+    if exact:
+        return _float_pow(x, y).astype(np.float64)
+    return np.power(x, y)
+
+
+def iter_tokens(corpus_file, chunk_size=1 << 20):
+    '''Yield the \\w+ tokens of a text without reading it all at once.
+
+    `corpus_file` can be a file object, which is read `chunk_size`
+    characters at a time, a string, or any iterable of text chunks. A token
+    that runs up to the end of a chunk is held back and joined with the
+    start of the next chunk, so the tokens are the same as
+    re.findall('\\w+', text) over the whole text.
+    '''
+    if isinstance(corpus_file, str):
+        chunks = [corpus_file]
+    elif hasattr(corpus_file, 'read'):
+        chunks = iter(lambda: corpus_file.read(chunk_size), '')
+    else:
+        chunks = corpus_file
+
+    carry = ''
+    for chunk in chunks:
+        text = carry + chunk
+        carry = ''
+        end = len(text)
+        for m in RE_WORD.finditer(text):
+            if m.end() == end:
+                carry = m.group()
+            else:
+                yield m.group()
+    if carry:
+        yield carry
+
+
+def _sequential_segment_sum(values, starts, lengths, short_segment=64):
+    '''Sum contiguous segments of `values` strictly left to right.
+
+    np.add.reduceat uses pairwise summation, which rounds differently from
+    the Python `sum` in compute_spectrum. Short segments are accumulated one
+    column at a time across all segments; long ones use np.cumsum, which is
+    sequential as well.
+    '''
+    totals = np.zeros(len(starts), dtype=np.float64)
+    short = np.flatnonzero(lengths <= short_segment)
+    for j in range(int(lengths[short].max()) if len(short) else 0):
+        short = short[lengths[short] > j]
+        totals[short] += values[starts[short] + j]
+    for i in np.flatnonzero(lengths > short_segment):
+        totals[i] = np.cumsum(values[starts[i]:starts[i] + lengths[i]])[-1]
+    return totals
+
+
+def level_statistics(positions, offsets, tot_words, exact=True):
+    '''Level statistics of every word of a positional index in one pass.
+
+    `positions` is a flat, integer array of token positions grouped by word
+    (ascending within each word), and `offsets` has one more entry than
+    there are words, so that the positions of word i are
+    positions[offsets[i]:offsets[i+1]].
+
+    Returns the arrays (count, C, sigma_nor); words with 3 or fewer
+    occurrences get C = 0 and sigma_nor = 0. With exact=True the arithmetic
+    follows compute_spectrum operation for operation, including the order
+    of summation and the C library pow(), so the values are identical to
+    the per word loop. exact=False uses NumPy's own power functions, which
+    is several times faster and agrees to within a few ulp.
+    '''
+    positions = np.asarray(positions, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    C = np.zeros(len(counts), dtype=np.float64)
+    sigma_nor = np.zeros(len(counts), dtype=np.float64)
+
+    words = np.flatnonzero(counts > 3)
+    if len(words) == 0:
+        return counts, C, sigma_nor
+
+    # position -> distance from preceding element in text, keeping only the
+    # gaps that fall inside the words being computed.
+    gaps = np.diff(positions)
+    n = counts[words]
+    lengths = n - 1
+    starts = np.zeros(len(words), dtype=np.int64)
+    starts[1:] = np.cumsum(lengths)[:-1]
+    selected = np.repeat(offsets[words], lengths) + (
+        np.arange(lengths.sum()) - np.repeat(starts, lengths))
+    tmp = gaps[selected]
+
+    avg = np.add.reduceat(tmp, starts).astype(np.float64) / lengths
+    dev = tmp - np.repeat(avg, lengths)
+    if exact:
+        sigma = _sequential_segment_sum(_power(dev, 2), starts, lengths)
+    else:
+        sigma = np.add.reduceat(dev * dev, starts)
+    sigma = _power(sigma / lengths, 0.5, exact) / avg
+
+    tot_words = np.asarray(tot_words)
+    if tot_words.ndim > 0:
+        tot_words = tot_words[words]
+    sigma_nor[words], C[words] = _normalize(sigma, n, tot_words, exact)
+    return counts, C, sigma_nor
+
+
+def segment_level_statistics(positions, offsets, boundaries, tot_words,
+                             exact=True):
+    '''Level statistics of every word within every segment of a text.
+
+    `positions` and `offsets` are a positional index as for
+    level_statistics, and `boundaries` are the positions at which segments
+    (chapters, sections, ...) start; the last segment runs to tot_words.
+    Positions before the first boundary are ignored.
+
+    Each word's positions are ascending, so its occurrences in one segment
+    are contiguous in `positions` and every (word, segment) pair becomes a
+    group of the same flat array. All pairs are then computed in a single
+    call to level_statistics, with the segment length in place of
+    tot_words.
+
+    Returns word by segment arrays (count, C, sigma_nor).
+    '''
+    positions = np.asarray(positions, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    boundaries = np.asarray(boundaries, dtype=np.int64)
+    n_words = len(offsets) - 1
+    n_segments = len(boundaries)
+    lengths = np.diff(np.append(boundaries, tot_words))
+
+    words = np.repeat(np.arange(n_words), np.diff(offsets))
+    segments = np.searchsorted(boundaries, positions, side='right') - 1
+    inside = segments >= 0
+    key = words[inside] * n_segments + segments[inside]
+    positions = positions[inside]
+
+    starts = np.flatnonzero(np.diff(key, prepend=-1))
+    group_offsets = np.append(starts, len(key))
+    group_key = key[starts]
+    counts, C, sigma_nor = level_statistics(
+        positions, group_offsets, lengths[group_key % n_segments], exact)
+
+    shape = (n_words, n_segments)
+    result = []
+    for values in (counts, C, sigma_nor):
+        matrix = np.zeros(shape, dtype=values.dtype)
+        matrix.flat[group_key] = values
+        result.append(matrix)
+    return tuple(result)
+
+
+def _normalize(sigma, n, tot_words, exact=True):
+    # Correct sigma for the word frequency p = n/tot_words and turn it into
+    # the C statistic.
+    n = n.astype(np.float64)
+    p = n / tot_words
+    sigma_nor = sigma / _power(1.0 - p, 0.5, exact)
+    C = (sigma_nor - (2.0*n - 1.0)/(2.0*n + 2.0)) \
+        * (_power(n, 0.5, exact) * (1.0 + 2.8*_power(n, -0.865, exact)))
+    return sigma_nor, C
+
+
+def score_at_percentile(a, per):
+    '''Score at percentile `per` of `a`, as scipy.stats.scoreatpercentile.
+
+    Uses np.partition to find the one or two order statistics needed rather
+    than sorting `a`, and interpolates between them the same way scipy does
+    (interpolation_method='fraction').
+    '''
+    a = np.asarray(a)
+    if a.size == 0:
+        return np.nan
+    if not (0 <= per <= 100):
+        raise ValueError("percentile must be in the range [0, 100]")
+
+    a = a.ravel()
+    idx = per / 100. * (a.size - 1)
+    i = int(idx)
+    if i == idx:
+        return np.partition(a, i)[i] * np.array(1) / 1.0
+    part = np.partition(a, [i, i + 1])
+    weights = np.array([(i + 1 - idx), (idx - i)], float)
+    return np.add.reduce(part[i:i + 2] * weights) / weights.sum()
+
+
+def table_to_pandas(table):
+    '''DataFrame of a dict of columns, such as level_stat, without copying.
+
+    pd.DataFrame(table) copies every column; here the numeric columns of
+    the frame are views of the table's arrays.
+    '''
+    import pandas as pd
+    return pd.DataFrame(table, copy=False)
+
+
+def table_to_arrow(table):
+    '''pyarrow Table of a dict of columns, such as level_stat.
+
+    Numeric columns are wrapped without copying; object columns (words,
+    doc ids) are converted to Arrow values. Requires pyarrow.
+    '''
+    import pyarrow as pa
+    columns = {}
+    for name, column in table.items():
+        if column.dtype == object:
+            columns[name] = pa.array(column.tolist())
+        else:
+            columns[name] = pa.array(column)
+    return pa.table(columns)
+
+
+def _frequency_rank(counts, rows):
+    '''Position of `rows` in the words sorted by descending count.
+
+    Equal counts keep vocabulary order, as in a stable sort, but the ranks
+    are found by counting rather than by sorting the whole vocabulary.
+    '''
+    counts = np.asarray(counts)
+    rows = np.asarray(rows, dtype=np.int64)
+    if len(rows) == 0:
+        return rows
+
+    # Words with a higher count.
+    histogram = np.bincount(counts)
+    higher = len(counts) - np.cumsum(histogram)
+    rank = higher[counts[rows]]
+
+    # Earlier words with the same count, among only the words that share a
+    # count with one of the rows.
+    ties = np.flatnonzero(np.isin(counts, counts[rows]))
+    ties = ties[np.argsort(counts[ties], kind='stable')]
+    tie_counts = counts[ties]
+    group_start = np.searchsorted(tie_counts, tie_counts, side='left')
+    earlier = np.zeros(len(counts), dtype=np.int64)
+    earlier[ties] = np.arange(len(ties)) - group_start
+    return rank + earlier[rows]
+
+
+# Null distributions of C in shuffled texts, keyed by (n, tot_words).
+_NULL_C = {}
+
+
+def _random_subsets(n, tot_words, size, rng):
+    '''`size` random n-subsets of range(tot_words), one per sorted row.
+
+    Draws with replacement and redraws the duplicates until every row is
+    distinct. Nothing in the procedure depends on the labels of positions,
+    so every n-subset is equally likely, as for the positions of a word
+    with n occurrences in a randomly shuffled text.
+    '''
+    if 2 * n > tot_words:
+        # Dense words: draw the positions the word does not occupy.
+        mask = np.ones((size, tot_words), dtype=bool)
+        rows = np.arange(size)[:, None]
+        free = _random_subsets(tot_words - n, tot_words, size, rng)
+        mask[rows, free] = False
+        return np.nonzero(mask)[1].reshape(size, n)
+
+    x = rng.integers(0, tot_words, size=(size, n))
+    while True:
+        x.sort(axis=1)
+        duplicate = x[:, 1:] == x[:, :-1]
+        if not duplicate.any():
+            return x
+        x[:, 1:][duplicate] = rng.integers(0, tot_words,
+                                           size=duplicate.sum())
+
+
+def null_distribution(n, tot_words, n_shuffles=1000, rng=None,
+                      batch_size=1 << 22):
+    '''Sorted values of C for a word with n occurrences in shuffled texts.
+
+    Simulates n_shuffles random placements of the word, in batches of about
+    batch_size positions, and computes C for all of them with
+    level_statistics. Results are cached per (n, tot_words).
+    '''
+    cached = _NULL_C.get((n, tot_words))
+    if cached is not None and len(cached) >= n_shuffles:
+        return cached
+    if rng is None:
+        rng = np.random.default_rng()
+
+    null = []
+    rows = max(1, batch_size // max(n, 1))
+    for start in range(0, n_shuffles, rows):
+        size = min(rows, n_shuffles - start)
+        positions = _random_subsets(n, tot_words, size, rng)
+        offsets = np.arange(size + 1, dtype=np.int64) * n
+        null.append(level_statistics(positions.ravel(), offsets, tot_words,
+                                     exact=False)[1])
+    null = np.sort(np.concatenate(null))
+    _NULL_C[(n, tot_words)] = null
+    return null
+
+
+def shuffle_p_values(counts, C, tot_words, n_shuffles=1000, seed=None):
+    '''Empirical p-values of C against randomly shuffled texts.
+
+    For each distinct count (frequency class) the null distribution of C
+    is simulated once, see null_distribution, and a word's p-value is the
+    share of shuffled texts with a C at least as large,
+    (1 + #{null >= C}) / (n_shuffles + 1). Words with 3 or fewer
+    occurrences always have C = 0 and get p = 1.
+    '''
+    counts = np.asarray(counts)
+    C = np.asarray(C)
+    rng = np.random.default_rng(seed)
+    p_values = np.ones(len(counts), dtype=np.float64)
+    words = np.flatnonzero(counts > 3)
+    classes, inverse = np.unique(counts[words], return_inverse=True)
+    for k, n in enumerate(classes):
+        null = null_distribution(int(n), tot_words, n_shuffles, rng)
+        members = words[inverse == k]
+        above = len(null) - np.searchsorted(null, C[members], side='left')
+        p_values[members] = (1.0 + above) / (len(null) + 1.0)
+    return p_values
+
+
+def _index_file(args):
+    # Runs in a worker process of WordLevelStatistics.from_files.
+    path, encoding, chunk_size = args
+    builder = PositionIndexBuilder()
+    with open(path, encoding=encoding) as fp:
+        builder.add(iter_tokens(fp, chunk_size))
+    return builder.build()
+
+
+class RunningLevelStatistics():
+    '''Running sufficient statistics of the gaps between word occurrences.
+
+    For every word it keeps the count, the last position, and the sum and
+    sum of squares of the gaps, which is enough to update sigma when more
+    text is appended. Only words touched since the last update() have their
+    sigma recomputed; the correction for p = n/tot_words, which changes for
+    every word as the text grows, is applied when spectra() is asked for.
+    '''
+    # The sums kept per word; sigma and touched follow from them.
+    SUMS = ('count', 'last', 'sum_gaps', 'sum_sq_gaps')
+
+    def __init__(self):
+        self.count = np.zeros(0, dtype=np.int64)
+        self.last = np.zeros(0, dtype=np.int64)
+        self.sum_gaps = np.zeros(0, dtype=np.int64)
+        self.sum_sq_gaps = np.zeros(0, dtype=np.int64)
+        self.sigma = np.zeros(0, dtype=np.float64)
+        self.touched = np.zeros(0, dtype=bool)
+
+    def _grow(self, n_words):
+        extra = n_words - len(self.count)
+        if extra > 0:
+            self.count = np.concatenate([self.count,
+                                         np.zeros(extra, np.int64)])
+            self.last = np.concatenate([self.last,
+                                        np.full(extra, -1, np.int64)])
+            self.sum_gaps = np.concatenate([self.sum_gaps,
+                                            np.zeros(extra, np.int64)])
+            self.sum_sq_gaps = np.concatenate([self.sum_sq_gaps,
+                                               np.zeros(extra, np.int64)])
+            self.sigma = np.concatenate([self.sigma, np.zeros(extra)])
+            self.touched = np.concatenate([self.touched,
+                                           np.zeros(extra, bool)])
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        '''Restore the statistics from the SUMS arrays, see arrays().'''
+        running = cls()
+        for name in cls.SUMS:
+            setattr(running, name, np.array(arrays[name], dtype=np.int64))
+        running.sigma = np.zeros(len(running.count), dtype=np.float64)
+        running.touched = np.ones(len(running.count), dtype=bool)
+        return running
+
+    @classmethod
+    def from_index(cls, index):
+        '''Statistics of the text of a PositionIndex.
+
+        Same as add(index.token_ids(), 0), but read off the positions of
+        each word directly instead of sorting the whole text again.
+        '''
+        starts, ends = index.offsets[:-1], index.offsets[1:]
+        count = ends - starts
+        seen = count > 0
+        positions = index.positions.astype(np.int64)
+        last = np.full(len(count), -1, dtype=np.int64)
+        last[seen] = positions[ends[seen] - 1]
+        sum_gaps = np.zeros(len(count), dtype=np.int64)
+        sum_gaps[seen] = last[seen] - positions[starts[seen]]
+
+        # Gap k is between positions k and k + 1, so the gaps of a word are
+        # those from its start to one before its end.
+        gaps = np.diff(positions)
+        cum_sq = np.zeros(len(positions), dtype=np.int64)
+        np.cumsum(gaps * gaps, out=cum_sq[1:])
+        sum_sq_gaps = cum_sq[np.maximum(ends - 1, starts)] - cum_sq[starts] \
+            if len(positions) else np.zeros(len(count), dtype=np.int64)
+        return cls.from_arrays({'count': count, 'last': last,
+                                'sum_gaps': sum_gaps,
+                                'sum_sq_gaps': sum_sq_gaps})
+
+    def arrays(self, n_words=None):
+        '''The SUMS arrays, padded to n_words words.'''
+        if n_words is not None:
+            self._grow(n_words)
+        return {name: getattr(self, name) for name in self.SUMS}
+
+    def add(self, token_ids, start):
+        '''Add the word ids of tokens at positions start, start + 1, ...'''
+        token_ids = np.asarray(token_ids, dtype=np.int64)
+        if len(token_ids) == 0:
+            return
+        self._grow(int(token_ids.max()) + 1)
+
+        # Group the new positions by word, in text order within each word.
+        order = np.argsort(token_ids, kind='stable')
+        words = token_ids[order]
+        positions = order + start
+        first = np.ones(len(words), dtype=bool)
+        first[1:] = words[1:] != words[:-1]
+
+        # Each occurrence follows the previous one of the same word, which
+        # for the first in this batch is the last one seen before.
+        previous = np.empty_like(positions)
+        previous[1:] = positions[:-1]
+        previous[first] = self.last[words[first]]
+        seen = previous >= 0
+        gaps = positions[seen] - previous[seen]
+        np.add.at(self.sum_gaps, words[seen], gaps)
+        np.add.at(self.sum_sq_gaps, words[seen], gaps * gaps)
+
+        self.count += np.bincount(words, minlength=len(self.count))
+        last = np.ones(len(words), dtype=bool)
+        last[:-1] = first[1:]
+        self.last[words[last]] = positions[last]
+        self.touched[words[first]] = True
+
+    def update(self):
+        '''Recompute sigma for the words touched since the last update.'''
+        words = np.flatnonzero(self.touched & (self.count > 3))
+        m = (self.count[words] - 1).astype(np.float64)
+        avg = self.sum_gaps[words] / m
+        variance = self.sum_sq_gaps[words] / m - avg * avg
+        self.sigma[words] = np.sqrt(np.maximum(variance, 0.0)) / avg
+        self.touched[:] = False
+        return words
+
+    def spectra(self, tot_words=None):
+        '''Return (count, C, sigma_nor) for every word.'''
+        self.update()
+        if tot_words is None:
+            tot_words = int(self.count.sum())
+        C = np.zeros(len(self.count), dtype=np.float64)
+        sigma_nor = np.zeros(len(self.count), dtype=np.float64)
+        words = np.flatnonzero(self.count > 3)
+        sigma_nor[words], C[words] = _normalize(
+            self.sigma[words], self.count[words], tot_words, exact=False)
+        return self.count.copy(), C, sigma_nor
 
 
 class WordLevelStatistics():
@@ -9,7 +480,8 @@ class WordLevelStatistics():
     #
     # This library is free software; you can redistribute it and/or
     # modify it under the same terms as Python itself.
-    def __init__(self, word_pos=None, corpus_file=None, percentile_C=95):
+    def __init__(self, word_pos=None, corpus_file=None, percentile_C=95,
+                 keep_tokens=False, chunk_size=1 << 20):
         '''This package is a port of the perl module Algorithm::WordLevelStatistics by
         Francesco Nidito which can be found at:
         http://search.cpan.org/~nids/Algorithm-WordLevelStatistics-0.03/
@@ -30,59 +502,301 @@ class WordLevelStatistics():
         Author: Shubhanshu Mishra
         Published: December 29, 2014
         License: GPL3
+
+        corpus_file is read in chunks of chunk_size characters, see
+        iter_tokens. The token sequence is rebuilt from the position index
+        when self.tokens is used and is only kept while the caller holds on
+        to it, unless keep_tokens is True.
         '''
         if percentile_C is not None:
             self.percentile_C = percentile_C
 
+        self.keep_tokens = keep_tokens
+        self.chunk_size = chunk_size
+        self._word_pos = None
+        self._builder = None
+        self._tokens = None
+        self._kept_tokens = None
+        self._running = None
+        self._spectra = None
+        self._level_stat = None
+        self._p_values = None
         if word_pos is not None:
             self.word_pos = word_pos
         elif corpus_file is not None:
-            self.word_pos = dict()
-            self.pos_counter = 0
             if isinstance(corpus_file, list):
                 for c in corpus_file:
                     self.gen_word_pos(c)
             else:
                 self.gen_word_pos(corpus_file)
 
+    @classmethod
+    def from_files(cls, paths, processes=None, encoding='utf-8', **kwargs):
+        '''Index a corpus split over several files in a process pool.
+
+        Each file is tokenized and indexed in a worker, then the shards are
+        merged with each one offset by the token count of the files before
+        it. The positions are the same as WordLevelStatistics(corpus_file=
+        [open(p) for p in paths]) would give. Remaining keyword arguments go
+        to the constructor.
+        '''
+        wls = cls(**kwargs)
+        jobs = [(path, encoding, wls.chunk_size) for path in paths]
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            shards = list(executor.map(_index_file, jobs))
+        wls.word_pos = PositionIndex.concatenate(shards)
+        return wls
+
+    def save(self, path, spectra=True):
+        '''Write the position index, and the spectra if computed, to path.
+
+        See load() and position_index.save_index for the format.
+        '''
+        index = self.word_pos
+        if not isinstance(index, PositionIndex):
+            index = PositionIndex.from_dict(index)
+        arrays = {}
+        meta = {'percentile_C': self.percentile_C}
+        if spectra and self._spectra is not None:
+            words, counts, C, sigma_nor = self._spectra
+            if words is not index.vocab and list(words) != index.vocab:
+                raise ValueError("Spectra are out of date, call "
+                                 "compute_spectra() before saving.")
+            arrays.update({'count': counts, 'C': C, 'sigma_nor': sigma_nor})
+            meta['tot_words'] = self.tot_words
+        # The running statistics let append() continue after load().
+        running = self._running
+        if running is None:
+            running = RunningLevelStatistics.from_index(index)
+        for name, values in running.arrays(len(index.vocab)).items():
+            arrays['running_' + name] = values
+        save_index(path, index, arrays, meta)
+
+    @classmethod
+    def load(cls, path, mmap=True, **kwargs):
+        '''Open an index written by save().
+
+        With mmap=True the positions are memory mapped read-only, so loading
+        takes milliseconds and worker processes opening the same file share
+        one copy in the page cache. Spectra saved with the index are
+        restored, so compute_spectra() need not be called again, and so are
+        the running statistics used by append() and update_spectra().
+        '''
+        index, arrays, meta = load_index(path, mmap=mmap)
+        kwargs.setdefault('percentile_C', meta.get('percentile_C', 95))
+        wls = cls(word_pos=index, **kwargs)
+        if 'C' in arrays:
+            wls.tot_words = meta['tot_words']
+            wls._set_level_stat(index.vocab, arrays['count'], arrays['C'],
+                                arrays['sigma_nor'])
+        if 'running_count' in arrays:
+            wls._running = RunningLevelStatistics.from_arrays(
+                {name: arrays['running_' + name]
+                 for name in RunningLevelStatistics.SUMS})
+        return wls
+
+    @property
+    def word_pos(self):
+        # Tokens added since the last access are indexed on demand.
+        if self._builder is not None and self._word_pos is None:
+            self._word_pos = self._builder.build()
+        return self._word_pos
+
+    @word_pos.setter
+    def word_pos(self, word_pos):
+        self._word_pos = word_pos
+        self._builder = None
+        self._running = None
+        self._tokens = None
+        self._kept_tokens = None
+
+    @property
+    def pos_counter(self):
+        if self._builder is not None:
+            return self._builder.pos_counter
+        if isinstance(self._word_pos, PositionIndex):
+            return self._word_pos.tot_words
+        if self._word_pos is not None:
+            return sum(len(p) for p in self._word_pos.values())
+        return 0
+
+    @property
+    def tokens(self):
+        # The sequence is reused for as long as anything refers to it: in
+        # `for n, w in enumerate(wls.tokens)` the loop's iterator does, so
+        # wls.tokens[...] inside it does not rebuild the sequence.
+        tokens = self._tokens() if self._tokens is not None else None
+        if tokens is None:
+            index = self.word_pos
+            if not isinstance(index, PositionIndex):
+                index = PositionIndex.from_dict(index)
+            tokens = TokenSequence(index.vocab, index.token_ids())
+            self._tokens = weakref.ref(tokens)
+            if self.keep_tokens:
+                self._kept_tokens = tokens
+        return tokens
+
     def gen_word_pos(self, corpus_file):
         # with open(corpus_file, encoding='utf-8') as fp:
-        text = corpus_file.read()  # .lower()
-        tokens = re.findall('\w+', text)
-        self.tokens = tokens
-        for t in tokens:
-            if t not in self.word_pos:
-                self.word_pos[t] = []
-            self.word_pos[t].append(self.pos_counter)
-            self.pos_counter += 1
-
-    def compute_spectra(self):
+        if self._builder is None:
+            if self._word_pos is None:
+                self._builder = PositionIndexBuilder()
+            else:
+                index = self._word_pos
+                if not isinstance(index, PositionIndex):
+                    index = PositionIndex.from_dict(index)
+                self._builder = PositionIndexBuilder.from_index(index)
+        self._builder.add(iter_tokens(corpus_file, self.chunk_size))
+        # Running statistics only follow text added through append().
+        self._running = None
+        self._word_pos = None
+        self._tokens = None
+        self._kept_tokens = None
+
+    def compute_spectra(self, exact=True):
         if self.word_pos is None or len(self.word_pos.keys()) < 1:
             return None
+        index = self.word_pos
+        if not isinstance(index, PositionIndex):
+            index = PositionIndex.from_dict(index)
+        words = index.vocab
+
         # Count total words in the text.
-        self.tot_words = sum([len(self.word_pos[k]) for k in self.word_pos.keys()])
+        self.tot_words = index.tot_words
 
         # Compute level statistics of all terms
-        self.level_stat = []
-        for k in self.word_pos.keys():
-            ls = self.compute_spectrum(k)
-            self.level_stat.append(ls)
+        counts, C, sigma_nor = level_statistics(index.positions, index.offsets,
+                                                self.tot_words, exact=exact)
+
+        self._set_level_stat(words, counts, C, sigma_nor)
 
-        # Sort level_stat frequency, use index in this list for vocab.
-        self.level_stat = sorted(self.level_stat,
-                                 key=lambda x: x['count'],
-                                 reverse=True)
+    def compute_segment_spectra(self, boundaries, exact=True):
+        '''Level statistics of every word in each segment of the text.
+
+        `boundaries` are the positions where segments start, e.g. the
+        chapter_boundaries collected while concatenating chapters. Returns
+        arrays (count, C, sigma_nor) of shape (words, segments), with rows in
+        the order of self.word_pos.vocab. See segment_level_statistics.
+        '''
+        index = self.word_pos
+        if not isinstance(index, PositionIndex):
+            index = PositionIndex.from_dict(index)
+        return segment_level_statistics(index.positions, index.offsets,
+                                        boundaries, index.tot_words, exact)
+
+    def append(self, corpus_file):
+        '''Add a document to the end of the text.
+
+        Running statistics are kept per word, so that update_spectra() only
+        has to recompute the words that occur in the new documents instead
+        of every spectrum.
+        '''
+        running = self._running
+        if running is None:
+            running = RunningLevelStatistics()
+            if self.word_pos is not None and len(self.word_pos) > 0:
+                index = self.word_pos
+                if not isinstance(index, PositionIndex):
+                    index = PositionIndex.from_dict(index)
+                running = RunningLevelStatistics.from_index(index)
 
-        # Add index to keep track of vocab, higher freq <-> higer index.
-        for n, vocab_entry in enumerate(self.level_stat):
-            vocab_entry['vocab_index'] = n
+        start = self.pos_counter
+        self.gen_word_pos(corpus_file)
+        # The builder only holds the ids of the text not yet indexed.
+        builder = self._builder
+        token_ids = np.frombuffer(builder.token_ids[start - builder.start:],
+                                  dtype=np.int32)
+        running.add(token_ids, start)
+        self._running = running
 
-        self.threshold = stats.scoreatpercentile(    ## TODO: Compute this directly, dont import extra lib.
-            [t['C'] for t in self.level_stat], self.percentile_C)
-        self.level_stat_thresholded = [t for t in self.level_stat if t['C'] > self.threshold]
+    def update_spectra(self):
+        '''Level statistics of the text built up with append().
+
+        Same results as compute_spectra(), up to rounding: sigma comes from
+        the running sums of gaps and squared gaps rather than from the
+        positions themselves.
+        '''
+        if self._running is None:
+            return self.compute_spectra(exact=False)
+        self.tot_words = self.pos_counter
+        counts, C, sigma_nor = self._running.spectra(self.tot_words)
+        if self._builder is not None:
+            words = self._builder.vocab
+        else:
+            words = self.word_pos.vocab
+        self._set_level_stat(words, counts, C, sigma_nor)
+
+    def calibrate(self, n_shuffles=1000, seed=None):
+        '''Attach shuffled-text p-values to the level statistics.
+
+        C is only asymptotically normalized and percentile_C is a heuristic
+        cutoff; this adds a 'p_value' to every level_stat row, estimated
+        from n_shuffles random shufflings of the text, see
+        shuffle_p_values. Call after compute_spectra().
+        '''
+        if self._spectra is None:
+            return None
+        words, counts, C, sigma_nor = self._spectra
+        p_values = shuffle_p_values(counts, C, self.tot_words, n_shuffles,
+                                    seed)
+        self._set_level_stat(words, counts, C, sigma_nor, p_values)
+        return p_values
+
+    def _set_level_stat(self, words, counts, C, sigma_nor, p_values=None):
+        self._spectra = (words, counts, C, sigma_nor)
+        self._level_stat = None
+        self._p_values = p_values
+
+        self.threshold = score_at_percentile(C, self.percentile_C)
+        selected = np.flatnonzero(C > self.threshold)
+
+        # Only the rows above the threshold are put in frequency order, the
+        # full table is left to the level_stat property.
+        selected = selected[np.argsort(-counts[selected], kind='stable')]
+        vocab_index = _frequency_rank(counts, selected)
+        self.level_stat_thresholded = self._level_stat_table(selected,
+                                                             vocab_index)
 
         # Significant terms
-        self.significant_terms = [t['word'] for t in self.level_stat_thresholded]
+        self.significant_terms = self.level_stat_thresholded['word'].tolist()
+
+    def _level_stat_table(self, rows, vocab_index):
+        '''Columns word, count, C, sigma_nor, vocab_index (and p_value)
+        for the given rows of the spectra, see level_stat.'''
+        words, counts, C, sigma_nor = self._spectra
+        if not isinstance(words, np.ndarray):
+            words = np.array(words, dtype=object)
+        table = {'word': words[rows],
+                 'count': np.asarray(counts[rows], dtype=np.int64),
+                 'C': np.asarray(C[rows], dtype=np.float64),
+                 'sigma_nor': np.asarray(sigma_nor[rows], dtype=np.float64),
+                 'vocab_index': np.asarray(vocab_index, dtype=np.int64)}
+        # Spectra are only defined for words seen more than 3 times.
+        short = table['count'] <= 3
+        table['C'][short] = 0
+        table['sigma_nor'][short] = 0
+        if self._p_values is not None:
+            table['p_value'] = np.asarray(self._p_values[rows],
+                                          dtype=np.float64)
+        return table
+
+    @property
+    def level_stat(self):
+        '''Level statistics of every word, in descending count order.
+
+        A dict of equal length arrays (columns), like
+        level_stat_thresholded; pd.DataFrame(level_stat) or
+        table_to_pandas(level_stat) gives the table.
+        '''
+        if self._level_stat is None and self._spectra is not None:
+            counts = self._spectra[1]
+            # Sort level_stat frequency, use index in this list for vocab.
+            order = np.argsort(-counts, kind='stable')
+
+            # Add index to keep track of vocab, higher freq <-> higer index.
+            self._level_stat = self._level_stat_table(
+                order, np.arange(len(order)))
+        return self._level_stat
 
     def compute_spectrum(self, word):
         positions = self.word_pos[word]
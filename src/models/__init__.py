@@ -1,5 +1,51 @@
 # -*- coding: utf-8 -*-
 
+import importlib
+import types
+
 from .WordLevelStatistics import *
-from .utilities import *
-from .normalize import *
+from .position_index import *
+from .collection import *
+from .cluster_cache import *
+
+# These modules pull in scikit-learn, hdbscan, scipy, jieba and
+# elasticsearch, so they are only imported when one of their names is first
+# used. Later modules win where names clash, as with the star imports.
+_LAZY_MODULES = {
+    'lsh': ('LSHIndex', 'recall_at_k'),
+    'utilities': (
+        'SearchBudgetExceeded', 'ParameterEvaluator', 'grid_search',
+        'coarse_to_fine_search', 'SEARCH_STRATEGIES',
+        'hdbscan_parameter_search', 'exemplar_rows', 'enumerate_exemplars',
+        'topic_order_index', 'pack_vectors', 'reduce_dimensions',
+        'filter_enrich_significant_terms', 'message_topics',
+        'iter_message_topics', 'enrich_significant_terms', 'topic_exemplars',
+        'display_topics'),
+    'normalize': (
+        'LANGS', 're_en', 'RE_PUNCTS', 'get_elasticsearch',
+        'create_elasticsearch_indices', 'ANALYZER_VERSION', 'TokenCache',
+        'SUDACHI_FORMS', 'SUDACHI_SPLIT_MODES', 'tokenize',
+        'shutdown_workers', 'tokenize_many', 'RETRY_STATUS',
+        'tokenize_async'),
+}
+_LAZY = {name: module for module, names in _LAZY_MODULES.items()
+         for name in names}
+
+__all__ = [name for name, value in globals().items()
+           if not (name.startswith('_')
+                   or isinstance(value, types.ModuleType))]
+__all__ += list(_LAZY)
+
+
+def __getattr__(name):
+    if name in _LAZY_MODULES:
+        return importlib.import_module('.' + name, __name__)
+    if name in _LAZY:
+        module = importlib.import_module('.' + _LAZY[name], __name__)
+        value = globals()[name] = getattr(module, name)
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_MODULES) | set(_LAZY))
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+# Part of every key, to be bumped when the clustering itself changes so
+# that results computed the old way are not reused.
+CACHE_VERSION = 1
+
+
+class ClusterCache():
+    '''Disk cache of clustering results, addressed by their inputs.
+
+    Each entry is one .npz file in `directory`, named by a SHA-256 of the
+    input matrix (shape, dtype and bytes) and the parameters, and holds
+    arrays plus a small JSON dict. Reading an entry marks it as recently
+    used; when the files take more than max_bytes the least recently used
+    are removed.
+    '''
+    def __init__(self, directory, max_bytes=256 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(X, **params):
+        X = np.ascontiguousarray(X)
+        digest = hashlib.sha256()
+        digest.update(json.dumps({'version': CACHE_VERSION,
+                                  'shape': X.shape,
+                                  'dtype': X.dtype.str,
+                                  'params': params},
+                                 sort_keys=True, default=str).encode('utf-8'))
+        digest.update(X.data)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        '''Return (arrays, meta) stored under key, or None.'''
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (OSError, ValueError):
+            return None
+        os.utime(path)
+        meta = json.loads(str(arrays.pop('__meta__')))
+        return arrays, meta
+
+    def put(self, key, arrays, meta=None):
+        '''Store arrays and a JSON-serializable meta dict under key.'''
+        fd, tmp = tempfile.mkstemp(suffix='.npz', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                np.savez(fp, __meta__=np.array(json.dumps(meta or {})),
+                         **arrays)
+            # Readers only ever see complete entries.
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        '''Remove least recently used entries until under max_bytes.'''
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npz') or name.startswith('tmp'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                os.unlink(os.path.join(self.directory, name))
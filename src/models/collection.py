@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from .position_index import PositionIndexBuilder
+from .WordLevelStatistics import (iter_tokens, level_statistics,
+                                  score_at_percentile)
+
+
+def _document_spectra(args):
+    '''Level statistics of one document, computed in a worker process.
+
+    The rows are written to a new shared memory block, laid out as
+    count (int64), C, sigma_nor (float64), the character offsets of the
+    words (int64) and the words themselves (utf-8). Only the block name and
+    sizes are sent back to the parent, which copies the rows out and
+    unlinks the block.
+    '''
+    text, percentile_C, significant_only, exact = args
+    builder = PositionIndexBuilder()
+    builder.add(iter_tokens(text))
+    index = builder.build()
+    if index.tot_words == 0:
+        return None, 0, 0, np.nan
+
+    counts, C, sigma_nor = level_statistics(index.positions, index.offsets,
+                                            index.tot_words, exact)
+    threshold = score_at_percentile(C, percentile_C)
+    rows = np.flatnonzero(C > threshold) if significant_only \
+        else np.arange(len(C))
+    rows = rows[np.argsort(-counts[rows], kind='stable')]
+
+    words = [index.vocab[i] for i in rows]
+    word_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(w) for w in words], out=word_offsets[1:])
+    data = ''.join(words).encode('utf-8')
+
+    n = len(rows)
+    size = 8 * (4 * n + 1) + len(data)
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    buf = block.buf
+    np.frombuffer(buf, np.int64, n, 0)[:] = counts[rows]
+    np.frombuffer(buf, np.float64, n, 8 * n)[:] = C[rows]
+    np.frombuffer(buf, np.float64, n, 16 * n)[:] = sigma_nor[rows]
+    np.frombuffer(buf, np.int64, n + 1, 24 * n)[:] = word_offsets
+    buf[8 * (4 * n + 1):size] = data
+    del buf
+    block.close()
+    # The block stays registered with the resource tracker, which the
+    # workers share with the parent (see collection_spectra): unlinking it
+    # there unregisters it, and blocks left behind are removed when the
+    # parent exits.
+    return block.name, n, len(data), threshold
+
+
+def _chunk_spectra(jobs):
+    '''_document_spectra of several documents, for one round trip.
+
+    If a document fails, the blocks of the ones before it are unlinked.
+    '''
+    results = []
+    try:
+        for job in jobs:
+            results.append(_document_spectra(job))
+    except BaseException:
+        _unlink_blocks(results)
+        raise
+    return results
+
+
+def _unlink_blocks(results):
+    for name, _, _, _ in results:
+        if name is None:
+            continue
+        try:
+            block = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            continue
+        block.close()
+        block.unlink()
+
+
+def _read_block(name, n, n_bytes):
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        buf = block.buf
+        counts = np.frombuffer(buf, np.int64, n, 0).copy()
+        C = np.frombuffer(buf, np.float64, n, 8 * n).copy()
+        sigma_nor = np.frombuffer(buf, np.float64, n, 16 * n).copy()
+        word_offsets = np.frombuffer(buf, np.int64, n + 1, 24 * n).tolist()
+        start = 8 * (4 * n + 1)
+        text = bytes(buf[start:start + n_bytes]).decode('utf-8')
+        del buf
+    finally:
+        block.close()
+        block.unlink()
+    words = [text[a:b] for a, b in zip(word_offsets[:-1], word_offsets[1:])]
+    return words, counts, C, sigma_nor
+
+
+def _append_rows(columns, doc_id, threshold, words, counts, C, sigma_nor):
+    n = len(words)
+    ids = np.empty(n, dtype=object)
+    ids.fill(doc_id)
+    columns['doc_id'].append(ids)
+    columns['word'].append(np.array(words, dtype=object))
+    columns['count'].append(counts)
+    columns['C'].append(C)
+    columns['sigma_nor'].append(sigma_nor)
+    columns['threshold'].append(np.full(n, threshold))
+
+
+def collection_spectra(documents, percentile_C=95, processes=None,
+                       significant_only=True, exact=True, chunksize=16):
+    '''Level statistics of many independent documents in a process pool.
+
+    `documents` is a dict of doc_id -> text, or an iterable of (doc_id,
+    text) pairs, e.g. the Meiroku Zasshi articles of one author. Every
+    document gets its own spectrum and threshold, as if a separate
+    WordLevelStatistics(percentile_C=percentile_C) had been built for it.
+
+    Returns one table, a dict of equal length arrays with columns doc_id,
+    word, count, C, sigma_nor and threshold. Rows of a document are
+    contiguous and in descending count order; with significant_only only
+    the rows above the document's threshold are kept.
+    pd.DataFrame(table) gives the combined significant terms.
+    '''
+    if hasattr(documents, 'items'):
+        documents = documents.items()
+    doc_ids, texts = [], []
+    for doc_id, text in documents:
+        doc_ids.append(doc_id)
+        texts.append(text)
+
+    jobs = [(text, percentile_C, significant_only, exact) for text in texts]
+    columns = {'doc_id': [], 'word': [], 'count': [], 'C': [],
+               'sigma_nor': [], 'threshold': []}
+    # Started before the workers, so that they use it rather than their own.
+    resource_tracker.ensure_running()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(_chunk_spectra, jobs[i:i + chunksize])
+                   for i in range(0, len(jobs), chunksize)]
+        done = 0
+        try:
+            for future in futures:
+                chunk_ids = doc_ids[done * chunksize:(done + 1) * chunksize]
+                for doc_id, (name, n, n_bytes, threshold) in zip(
+                        chunk_ids, future.result()):
+                    if name is None:
+                        continue
+                    _append_rows(columns, doc_id, threshold,
+                                 *_read_block(name, n, n_bytes))
+                done += 1
+        finally:
+            # After a failure, remove the blocks of the chunks not read.
+            pending = futures[done:]
+            for future in pending:
+                future.cancel()
+            wait(pending)
+            for future in pending:
+                if not future.cancelled() and future.exception() is None:
+                    _unlink_blocks(future.result())
+
+    dtypes = {'doc_id': object, 'word': object, 'count': np.int64,
+              'C': np.float64, 'sigma_nor': np.float64,
+              'threshold': np.float64}
+    return {k: np.concatenate(v) if v else np.zeros(0, dtype=dtypes[k])
+            for k, v in columns.items()}
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+
+class LSHIndex():
+    '''Locality-sensitive hash index for approximate nearest neighbours.
+
+    Each of n_tables hash tables has n_bits hyperplanes. As in the LSH
+    notebook, a hyperplane is the perpendicular bisector of two vectors
+    sampled from the data, and bit j of a vector's hash is whether it lies
+    on the first vector's side. All hyperplanes of all tables are applied
+    in one matrix product, and each table is stored as its codes sorted
+    together with the row numbers, so a bucket is a contiguous slice found
+    by binary search.
+
+    Queries take the union of the query's buckets over all tables as
+    candidates and rank them by Euclidean distance.
+    '''
+    def __init__(self, n_tables=16, n_bits=12, random_state=None):
+        if not 0 < n_bits < 64:
+            raise ValueError("n_bits must be between 1 and 63")
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.random_state = random_state
+
+    def fit(self, X):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        self.X = X
+        rng = np.random.default_rng(self.random_state)
+        n_planes = self.n_tables * self.n_bits
+        if not (X != X[:1]).any():
+            raise ValueError("X needs at least two distinct rows")
+        sample = rng.choice(len(X), size=2 * n_planes,
+                            replace=2 * n_planes > len(X))
+        a, b = X[sample[:n_planes]], X[sample[n_planes:]]
+        # Equal vectors, drawn with replacement or duplicated in X, have
+        # no bisector; draw the second vector of those pairs again.
+        same = np.flatnonzero((a == b).all(axis=1))
+        while len(same):
+            b[same] = X[rng.integers(len(X), size=len(same))]
+            same = same[(a[same] == b[same]).all(axis=1)]
+        midpoints = (a + b) / 2
+        self.normals = np.ascontiguousarray(a - midpoints)
+        self.thresholds = np.einsum('ij,ij->i', self.normals, midpoints)
+        self._weights = (1 << np.arange(self.n_bits, dtype=np.uint64))
+
+        codes = self.hash(X)
+        self.order = np.argsort(codes, axis=0, kind='stable').T.astype(
+            np.int32 if len(X) < np.iinfo(np.int32).max else np.int64)
+        self.codes = np.take_along_axis(codes.T, self.order, axis=1)
+        return self
+
+    def hash(self, X, batch_size=1 << 14):
+        '''Hash codes of the rows of X, an array of shape (rows, tables).'''
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        codes = np.empty((len(X), self.n_tables), dtype=np.uint64)
+        for start in range(0, len(X), batch_size):
+            bits = X[start:start + batch_size] @ self.normals.T \
+                > self.thresholds
+            bits = bits.reshape(len(bits), self.n_tables, self.n_bits)
+            codes[start:start + batch_size] = bits @ self._weights
+        return codes
+
+    def candidates(self, Q):
+        '''Candidate neighbours of each row of Q.
+
+        Returns (query, row) arrays of pairs, sorted by query and then row,
+        with duplicates across tables removed.
+        '''
+        codes = self.hash(Q)
+        queries, rows = [], []
+        for t in range(self.n_tables):
+            left = np.searchsorted(self.codes[t], codes[:, t], side='left')
+            right = np.searchsorted(self.codes[t], codes[:, t], side='right')
+            sizes = right - left
+            # Positions left[q], ..., right[q] - 1 of every query q.
+            query = np.repeat(np.arange(len(Q)), sizes)
+            position = np.arange(sizes.sum()) - np.repeat(
+                np.cumsum(sizes) - sizes - left, sizes)
+            queries.append(query)
+            rows.append(self.order[t][position])
+        pairs = np.sort(np.concatenate(queries).astype(np.int64)
+                        * len(self.X) + np.concatenate(rows))
+        pairs = pairs[np.concatenate(([True], pairs[1:] != pairs[:-1]))]
+        return pairs // len(self.X), pairs % len(self.X)
+
+    def sq_distances(self, Q, query, row, batch_size=1 << 20):
+        '''Squared distances between Q[query] and the indexed X[row].
+
+        The differences are formed batch_size values at a time, so that
+        they stay small however many candidate pairs there are.
+        '''
+        dist = np.empty(len(query), dtype=np.float32)
+        step = max(1, batch_size // self.X.shape[1])
+        for start in range(0, len(query), step):
+            pairs = slice(start, start + step)
+            diff = self.X[row[pairs]] - Q[query[pairs]]
+            dist[pairs] = np.einsum('ij,ij->i', diff, diff)
+        return dist
+
+    def kneighbors(self, Q=None, n_neighbors=10, return_distance=False,
+                   batch_size=1024):
+        '''Approximate n_neighbors nearest rows of the index for each row
+        of Q (the indexed rows themselves by default).
+
+        Returns indices of shape (queries, n_neighbors), nearest first, and
+        the distances if return_distance. Where fewer candidates than
+        n_neighbors share a bucket with a query the rest is -1 (distance
+        inf).
+        '''
+        Q = self.X if Q is None else np.ascontiguousarray(Q,
+                                                          dtype=np.float32)
+        indices = np.full((len(Q), n_neighbors), -1, dtype=np.int64)
+        distances = np.full((len(Q), n_neighbors), np.inf)
+        for start in range(0, len(Q), batch_size):
+            batch = Q[start:start + batch_size]
+            query, row = self.candidates(batch)
+            dist = self.sq_distances(batch, query, row)
+            # Nearest first within each query; the pairs come sorted by row,
+            # so the stable sort breaks ties by row.
+            order = np.lexsort((dist, query))
+            query, row, dist = query[order], row[order], dist[order]
+            sizes = np.bincount(query, minlength=len(batch))
+            rank = np.arange(len(query)) - np.repeat(np.cumsum(sizes) - sizes,
+                                                     sizes)
+            top = rank < n_neighbors
+            indices[start + query[top], rank[top]] = row[top]
+            distances[start + query[top], rank[top]] = np.sqrt(dist[top])
+
+        if return_distance:
+            return distances, indices
+        return indices
+
+    def recall(self, Q=None, n_neighbors=10):
+        '''Recall@n_neighbors of kneighbors against exact neighbours.
+
+        The exact neighbours come from the brute-force NearestNeighbors
+        used in the LSH notebook. Returns the recall of every query.
+        '''
+        Q = self.X if Q is None else Q
+        knn = NearestNeighbors(n_neighbors=n_neighbors, algorithm='brute',
+                               metric='euclidean')
+        exact = knn.fit(self.X).kneighbors(Q, return_distance=False)
+        return recall_at_k(self.kneighbors(Q, n_neighbors), exact)
+
+
+def recall_at_k(approximate, exact):
+    '''Fraction of each row of exact neighbours found in approximate.'''
+    approximate = np.asarray(approximate)
+    exact = np.asarray(exact)
+    found = (approximate[:, :, None] == exact[:, None, :]).any(axis=1)
+    return found.sum(axis=1) / exact.shape[1]
@@ -1,14 +1,21 @@
 #!/usr/bin/env python
 
+import asyncio
+import hashlib
 import html
+import sqlite3
+import threading
 import string
 import re
-from typing import List
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Iterable, List
 
 import defopt
 import jieba
 import zhon.hanzi
 from elasticsearch import Elasticsearch
+from elasticsearch import exceptions as es_exceptions
 from logzero import logger
 
 
@@ -16,7 +23,7 @@ from logzero import logger
 # TODO: rewerite this whole module to use Sentences class to do tokenization
 
 # TODO: this should probably be in a config file somewhere
-LANGS = ["en", "ko", "zh", "es", "fr"]
+LANGS = ["en", "ko", "zh", "es", "fr", "ja"]
 
 
 # string.punctuation, except for '
@@ -33,8 +40,28 @@ RE_PUNCTS = {
     "ko": re.compile(rf"[{zhon.hanzi.punctuation + string.punctuation}]"),
     "es": re.compile(rf"[{string.punctuation}]"),
     "fr": re.compile(rf"[{string.punctuation}]"),
+    # zhon's CJK punctuation covers 、。「」『』 etc., but not the middle dot
+    "ja": re.compile(rf"[{zhon.hanzi.punctuation + string.punctuation}・]"),
 }
 
+# One client (and connection pool) per elasticsearch host, shared by all
+# calls in the process
+_ES_CLIENTS = {}
+
+
+def get_elasticsearch(
+    host: str = "localhost", port: int = 9200
+) -> Elasticsearch:
+    """
+    Return the pooled elasticsearch client for host:port, creating it on
+    first use
+    """
+    es = _ES_CLIENTS.get((host, port))
+    if es is None:
+        es = _ES_CLIENTS[(host, port)] = Elasticsearch([f"{host}:{port}"])
+    return es
+
+
 # Elasticsearch segmentation
 def create_elasticsearch_indices(
     langs: List[str] = ["en", "ko", "zh", "es", "fr"],
@@ -166,7 +193,7 @@ def create_elasticsearch_indices(
         },
     }
 
-    es = Elasticsearch([f"{host}:{port}"])
+    es = get_elasticsearch(host, port)
     for lang in indices:
         if es.indices.exists(index=lang):
             if rebuild:
@@ -176,6 +203,221 @@ def create_elasticsearch_indices(
             es.indices.create(index=lang, body=indices[lang])
 
 
+# Bump when the analyzers of create_elasticsearch_indices change, so that
+# cached tokenizations made with the old ones are not reused
+ANALYZER_VERSION = "1"
+
+
+class TokenCache:
+    """
+    Two level cache of tokenized strings: an in-process LRU of up to
+    maxsize entries, backed by an optional SQLite file at path that
+    persists across runs
+
+    Keys combine the language, tokenizer, drop_punctuation, analyzer
+    version and a digest of the raw text (see key). hits and misses count
+    lookups; disk_hits is the part of hits served from SQLite.
+    """
+
+    def __init__(self, maxsize: int = 100000, path: str = None):
+        self.maxsize = maxsize
+        self.path = path
+        self._lru = OrderedDict()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS tokens "
+                "(key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self._db.commit()
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+
+    @staticmethod
+    def key(
+        s: str,
+        lang: str,
+        tokenizer: str,
+        drop_punctuation: bool,
+        analyzer_version: str = ANALYZER_VERSION,
+    ) -> str:
+        digest = hashlib.blake2b(s.encode("utf-8"), digest_size=16)
+        return (
+            f"{lang}:{tokenizer}:{int(drop_punctuation)}:"
+            f"{analyzer_version}:{digest.hexdigest()}"
+        )
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+        }
+
+    def _remember(self, key: str, value: str) -> None:
+        self._lru[key] = value
+        self._lru.move_to_end(key)
+        if len(self._lru) > self.maxsize:
+            self._lru.popitem(last=False)
+
+    def get_many(self, keys: List[str]) -> List[str]:
+        """
+        Return the cached value of every key, None where there is none
+        """
+        values = [self._lru.get(k) for k in keys]
+        missing = [k for k, v in zip(keys, values) if v is None]
+        found = {}
+        if missing and self._db is not None:
+            # SQLite limits the number of parameters of a statement
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                found.update(
+                    self._db.execute(
+                        "SELECT key, value FROM tokens "
+                        f"WHERE key IN ({marks})",
+                        chunk,
+                    )
+                )
+        for i, k in enumerate(keys):
+            if values[i] is None and k in found:
+                values[i] = found[k]
+                self.disk_hits += 1
+            if values[i] is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._remember(k, values[i])
+        return values
+
+    def get(self, key: str) -> str:
+        return self.get_many([key])[0]
+
+    def put_many(self, items: List[tuple]) -> None:
+        """
+        Store (key, value) pairs in both levels
+        """
+        for k, v in items:
+            self._remember(k, v)
+        if self._db is not None:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO tokens (key, value) VALUES (?, ?)",
+                items,
+            )
+            self._db.commit()
+
+    def put(self, key: str, value: str) -> None:
+        self.put_many([(key, value)])
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def _preprocess(s: str, lang: str, drop_punctuation: bool) -> str:
+    # unescape html special characters, eg '%gt;' -> '>'
+    s = html.unescape(s)
+
+    if drop_punctuation:
+        s = RE_PUNCTS[lang].sub("", s.replace("\\", ""))
+    return s
+
+
+# Sudachi dictionaries of this process, per (config, dict), loaded on first
+# use, and a tokenizer per thread on top of each (sudachi tokenizers are not
+# thread-safe)
+_SUDACHI = {}
+_SUDACHI_LOCK = threading.Lock()
+_SUDACHI_LOCAL = threading.local()
+
+SUDACHI_FORMS = ("surface", "dictionary_form", "normalized_form")
+SUDACHI_SPLIT_MODES = ("A", "B", "C")
+
+
+def _sudachi_tokenizer(config: str = None, system_dict: str = None):
+    key = (config, system_dict)
+    tokenizers = getattr(_SUDACHI_LOCAL, "tokenizers", None)
+    if tokenizers is None:
+        tokenizers = _SUDACHI_LOCAL.tokenizers = {}
+    tok = tokenizers.get(key)
+    if tok is None:
+        # threads starting together load the dictionary only once
+        with _SUDACHI_LOCK:
+            if key not in _SUDACHI:
+                from sudachipy import dictionary
+
+                _SUDACHI[key] = dictionary.Dictionary(
+                    config_path=config, dict=system_dict
+                )
+        tok = tokenizers[key] = _SUDACHI[key].create()
+    return tok
+
+
+def _sudachi_tokens(
+    s: str,
+    split_mode: str,
+    sudachi_form: str,
+    sudachi_config: str = None,
+    sudachi_dict: str = None,
+) -> str:
+    from sudachipy import tokenizer as sudachi_tokenizer
+
+    if sudachi_form not in SUDACHI_FORMS:
+        raise ValueError(f"Unknown sudachi form: {sudachi_form}")
+    if split_mode not in SUDACHI_SPLIT_MODES:
+        raise ValueError(f"Unknown sudachi split mode: {split_mode}")
+    mode = getattr(sudachi_tokenizer.Tokenizer.SplitMode, split_mode)
+    tok = _sudachi_tokenizer(sudachi_config, sudachi_dict)
+    morphemes = tok.tokenize(s, mode)
+    forms = [getattr(m, sudachi_form)().strip() for m in morphemes]
+    return " ".join([f for f in forms if f])
+
+
+def _tokenizer_key(
+    tokenizer: str,
+    split_mode: str,
+    sudachi_form: str,
+    sudachi_config: str = None,
+    sudachi_dict: str = None,
+) -> str:
+    # the tokenizer as named in cache keys, with its options
+    if tokenizer != "sudachi":
+        return tokenizer
+    name = f"sudachi-{split_mode}-{sudachi_form}"
+    if sudachi_config is not None:
+        name += f"-config={sudachi_config}"
+    if sudachi_dict is not None:
+        name += f"-dict={sudachi_dict}"
+    return name
+
+
+def _tokenize_cached(
+    cache: TokenCache,
+    analyzer_version: str,
+    s: str,
+    lang: str,
+    drop_punctuation: bool,
+    tokenizer: str,
+    *args,
+    **options,
+) -> str:
+    # tokenize(s, ...) looked up in and stored to cache
+    name = _tokenizer_key(tokenizer, **options)
+    key = cache.key(s, lang, name, drop_punctuation, analyzer_version)
+    tokens = cache.get(key)
+    if tokens is None:
+        tokens = tokenize(
+            s, lang, drop_punctuation, tokenizer, *args, **options
+        )
+        if isinstance(tokens, str):
+            cache.put(key, tokens)
+    return tokens
+
+
 def tokenize(
     s: str,
     lang: str = "en",
@@ -184,6 +426,12 @@ def tokenize(
     es: Elasticsearch = None,
     host: str = "localhost",
     port: int = 9200,
+    cache: TokenCache = None,
+    analyzer_version: str = ANALYZER_VERSION,
+    split_mode: str = "C",
+    sudachi_form: str = "surface",
+    sudachi_config: str = None,
+    sudachi_dict: str = None,
 ) -> List[str]:
     """
     Return tokenized string from string, accoding to tokenizer
@@ -195,22 +443,38 @@ def tokenize(
     :param s: utf-8 string (a sentence)
     :param lang: 2-character language id
     :param drop_punctuation: If True, remove punctuation characters
-    :param tokenizer: one of elasticsearch, jieba, pylucene, or None (which does
-        naive splitting on whitespace)
+    :param tokenizer: one of elasticsearch, jieba, sudachi, pylucene, or None
+        (which does naive splitting on whitespace)
     :param es: elasticsearch client to use
     :param host: elaticsearch hostname (only applies if
         tokenizer==`elasticsearch`, ignored if es is passed directly)
     :param port: elaticsearch port (only applies if tokenizer==`elasticsearch`,
         ignored if es is passed directly)
+    :param cache: TokenCache to look up and store the result in
+    :param analyzer_version: part of the cache key, see ANALYZER_VERSION
+    :param split_mode: sudachi split mode, A (shortest units), B or C
+        (longest units, e.g. named entities)
+    :param sudachi_form: the form of each morpheme sudachi returns, one of
+        surface, dictionary_form or normalized_form
+    :param sudachi_config: path to the sudachi.json to load the dictionary
+        with, e.g. the one the Makefile sets up for system_full.dic. None
+        for SudachiPy's default settings
+    :param sudachi_dict: sudachi system dictionary, the name of an
+        installed sudachidict_* package (core, full, ...) or an absolute
+        path to a .dic file; takes precedence over the one in
+        sudachi_config
     """
     # TODO: rename mathod to tokenizer, either a str or Callable, and
     # propagate to all functions in the call stack
 
-    # unescape html special characters, eg '%gt;' -> '>'
-    s = html.unescape(s)
+    if cache is not None:
+        return _tokenize_cached(
+            cache, analyzer_version, s, lang, drop_punctuation, tokenizer,
+            es, host, port, split_mode=split_mode, sudachi_form=sudachi_form,
+            sudachi_config=sudachi_config, sudachi_dict=sudachi_dict,
+        )
 
-    if drop_punctuation:
-        s = RE_PUNCTS[lang].sub("", s.replace("\\", ""))
+    s = _preprocess(s, lang, drop_punctuation)
 
     if tokenizer is None:
         # naive splitting on whitespace
@@ -218,7 +482,7 @@ def tokenize(
 
     elif tokenizer == "elasticsearch":
         if es is None:
-            es = Elasticsearch([f"{host}:{port}"])
+            es = get_elasticsearch(host, port)
 
         # TODO: fail gracefully if elasticsearch isn't running?
         resp = es.indices.analyze(index=lang, body={"analyzer": lang, "text": s})
@@ -237,6 +501,12 @@ def tokenize(
         tokens = jieba.cut(s, cut_all=False, HMM=True)
         return " ".join([t.strip() for t in tokens])
 
+    elif tokenizer == "sudachi":
+        # the dictionary is loaded once per process
+        return _sudachi_tokens(
+            s, split_mode, sudachi_form, sudachi_config, sudachi_dict
+        )
+
     elif tokenizer == "pylucene":
         # TODO: implement pylucene, or remove the tokenizer entirely
         raise NotImplementedError
@@ -247,5 +517,320 @@ def tokenize(
         raise ValueError(f"Unknown tokenizer: {tokenizer}")
 
 
+def _utf16_len(s: str) -> int:
+    # elasticsearch offsets count UTF-16 code units, as java strings do
+    return len(s.encode("utf-16-le")) // 2
+
+
+def _split_tokens(resp: dict, texts: List[str]) -> List[str]:
+    """
+    Split the response to an _analyze request for an array of texts back
+    into the tokenized string of each text
+
+    elasticsearch analyzes the array as one stream in which each text
+    starts one offset after the end of the previous one (the analyzer's
+    offset gap), so the start offset of every token tells which text it
+    came from.
+    """
+    starts = []
+    offset = 0
+    for t in texts:
+        starts.append(offset)
+        offset += _utf16_len(t) + 1
+
+    tokens = [[] for _ in texts]
+    i = 0
+    for token in resp.get("tokens", []) if resp else []:
+        while i + 1 < len(starts) and token["start_offset"] >= starts[i + 1]:
+            i += 1
+        tokens[i].append(token["token"])
+    return [" ".join(t) for t in tokens]
+
+
+def _analyze_batch(
+    es: Elasticsearch, lang: str, texts: List[str]
+) -> List[str]:
+    """
+    Tokenize a batch of texts with one _analyze request
+    """
+    resp = es.indices.analyze(
+        index=lang, body={"analyzer": lang, "text": texts}
+    )
+    return _split_tokens(resp, texts)
+
+
+def _batches(texts: Iterable[str], batch_size: int, max_chars: int):
+    batch, chars = [], 0
+    for t in texts:
+        if batch and (len(batch) == batch_size or chars + len(t) > max_chars):
+            yield batch
+            batch, chars = [], 0
+        batch.append(t)
+        chars += len(t)
+    if batch:
+        yield batch
+
+
+# Warm worker processes of tokenize_many, per (tokenizer, workers,
+# sudachi_config, sudachi_dict)
+_WORKER_POOLS = {}
+
+
+def _warm_worker(
+    tokenizer: str, sudachi_config: str = None, sudachi_dict: str = None
+) -> None:
+    # load the dictionary up front rather than on the first text
+    if tokenizer == "jieba":
+        jieba.initialize()
+    elif tokenizer == "sudachi":
+        _sudachi_tokenizer(sudachi_config, sudachi_dict)
+
+
+def _tokenize_chunk(args) -> List[str]:
+    texts, lang, drop_punctuation, tokenizer, options = args
+    return [
+        tokenize(s, lang, drop_punctuation, tokenizer, **options)
+        for s in texts
+    ]
+
+
+def _worker_pool(
+    tokenizer: str,
+    workers: int,
+    sudachi_config: str = None,
+    sudachi_dict: str = None,
+) -> ProcessPoolExecutor:
+    key = (tokenizer, workers, sudachi_config, sudachi_dict)
+    pool = _WORKER_POOLS.get(key)
+    if pool is None:
+        pool = _WORKER_POOLS[key] = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_warm_worker,
+            initargs=(tokenizer, sudachi_config, sudachi_dict),
+        )
+    return pool
+
+
+def shutdown_workers() -> None:
+    """
+    Stop the worker processes kept by tokenize_many
+    """
+    while _WORKER_POOLS:
+        _, pool = _WORKER_POOLS.popitem()
+        pool.shutdown()
+
+
+def tokenize_many(
+    texts: Iterable[str],
+    lang: str = "en",
+    drop_punctuation: bool = True,
+    tokenizer: str = "elasticsearch",
+    es: Elasticsearch = None,
+    host: str = "localhost",
+    port: int = 9200,
+    batch_size: int = 256,
+    max_chars: int = 10000,
+    cache: TokenCache = None,
+    analyzer_version: str = ANALYZER_VERSION,
+    workers: int = 1,
+    split_mode: str = "C",
+    sudachi_form: str = "surface",
+    sudachi_config: str = None,
+    sudachi_dict: str = None,
+) -> List[str]:
+    """
+    Return the tokenized string of every text, in order, as tokenize would
+
+    With tokenizer=='elasticsearch' up to batch_size texts are analyzed per
+    request, using the pooled client for host:port unless es is passed. A
+    request is also cut at max_chars characters, which keeps it under
+    elasticsearch's index.analyze.max_token_count (10000 by default).
+    Analyzers with char filters that change the text length would break the
+    offset bookkeeping; the analyzers of create_elasticsearch_indices have
+    none.
+
+    :param texts: iterable of utf-8 strings (sentences)
+    :param batch_size: maximum number of texts per _analyze request
+    :param max_chars: maximum number of characters per _analyze request
+    :param cache: TokenCache to look up texts in first; only the distinct
+        texts it does not have are tokenized, and then stored in it
+    :param workers: for the in-process tokenizers (jieba, sudachi), the
+        number of worker processes; texts are sent to them in chunks of
+        batch_size.
+        The workers load the tokenizer's dictionary when they start and
+        are kept for later calls, see shutdown_workers.
+    See tokenize for the other parameters.
+    """
+    options = {
+        "split_mode": split_mode,
+        "sudachi_form": sudachi_form,
+        "sudachi_config": sudachi_config,
+        "sudachi_dict": sudachi_dict,
+    }
+    if cache is not None:
+        texts = list(texts)
+        name = _tokenizer_key(tokenizer, **options)
+        keys = [
+            cache.key(s, lang, name, drop_punctuation, analyzer_version)
+            for s in texts
+        ]
+        tokenized = cache.get_many(keys)
+        missing = {}
+        for k, s, t in zip(keys, texts, tokenized):
+            if t is None:
+                missing.setdefault(k, s)
+        if missing:
+            new = tokenize_many(
+                missing.values(), lang, drop_punctuation, tokenizer, es, host,
+                port, batch_size, max_chars, workers=workers, **options
+            )
+            new = dict(zip(missing.keys(), new))
+            cache.put_many(list(new.items()))
+            tokenized = [
+                new[k] if t is None else t for k, t in zip(keys, tokenized)
+            ]
+        return tokenized
+
+    if tokenizer != "elasticsearch" and workers > 1:
+        chunks = (
+            (batch, lang, drop_punctuation, tokenizer, options)
+            for batch in _batches(texts, batch_size, float("inf"))
+        )
+        tokenized = []
+        pool = _worker_pool(tokenizer, workers, sudachi_config, sudachi_dict)
+        for chunk in pool.map(_tokenize_chunk, chunks):
+            tokenized.extend(chunk)
+        return tokenized
+
+    if tokenizer != "elasticsearch":
+        return [
+            tokenize(
+                s, lang, drop_punctuation, tokenizer, es, host, port,
+                **options
+            )
+            for s in texts
+        ]
+
+    texts = (_preprocess(s, lang, drop_punctuation) for s in texts)
+    if es is None:
+        es = get_elasticsearch(host, port)
+    tokenized = []
+    for batch in _batches(texts, batch_size, max_chars):
+        tokenized.extend(_analyze_batch(es, lang, batch))
+    return tokenized
+
+
+# Failures worth retrying: no connection, timeouts, and the cluster
+# rejecting or failing to route requests while overloaded
+RETRY_STATUS = (429, 502, 503, 504)
+
+
+def _retryable(ex: Exception) -> bool:
+    if isinstance(ex, (es_exceptions.ConnectionError, asyncio.TimeoutError)):
+        return True
+    return (
+        isinstance(ex, es_exceptions.TransportError)
+        and ex.status_code in RETRY_STATUS
+    )
+
+
+async def _analyze_batch_async(
+    es, lang: str, texts: List[str], retries: int, backoff: float
+) -> List[str]:
+    for attempt in range(retries + 1):
+        try:
+            resp = await es.indices.analyze(
+                index=lang, body={"analyzer": lang, "text": texts}
+            )
+            return _split_tokens(resp, texts)
+        except Exception as ex:
+            if attempt == retries or not _retryable(ex):
+                raise
+            delay = backoff * 2 ** attempt
+            logger.warning(f"_analyze failed ({ex!r}), retrying in {delay}s")
+            await asyncio.sleep(delay)
+
+
+async def _abatches(texts, batch_size: int, max_chars: int):
+    batch, chars = [], 0
+    if hasattr(texts, "__aiter__"):
+        async for t in texts:
+            full = len(batch) == batch_size or chars + len(t) > max_chars
+            if batch and full:
+                yield batch
+                batch, chars = [], 0
+            batch.append(t)
+            chars += len(t)
+        if batch:
+            yield batch
+    else:
+        for batch in _batches(texts, batch_size, max_chars):
+            yield batch
+
+
+async def tokenize_async(
+    texts,
+    lang: str = "en",
+    drop_punctuation: bool = True,
+    es=None,
+    host: str = "localhost",
+    port: int = 9200,
+    batch_size: int = 256,
+    max_chars: int = 10000,
+    max_in_flight: int = 8,
+    retries: int = 3,
+    backoff: float = 0.5,
+) -> AsyncIterator[str]:
+    """
+    Tokenize texts with elasticsearch, yielding the tokenized strings in
+    input order
+
+    Texts are batched as in tokenize_many, and up to max_in_flight _analyze
+    requests run concurrently on an AsyncElasticsearch client, so one slow
+    request does not hold up the others (only the yielding of the results
+    after it). Connection errors, timeouts and 429/502/503/504 responses
+    are retried up to retries times, waiting backoff, 2*backoff, ...
+    seconds; other errors are raised.
+
+    :param texts: iterable or async iterable of utf-8 strings (sentences)
+    :param es: AsyncElasticsearch client to use. If None a client for
+        host:port is opened for the run and closed at the end (requires
+        the aiohttp extra of elasticsearch). Retries are done here, so a
+        client passed in should be created with max_retries=0, or each of
+        them is multiplied by the transport's own retries.
+    :param max_in_flight: maximum number of concurrent _analyze requests
+    :param retries: maximum number of retries of a request
+    :param backoff: seconds to wait before the first retry, doubling after
+    See tokenize_many for the other parameters.
+    """
+    own_client = es is None
+    if own_client:
+        from elasticsearch import AsyncElasticsearch
+
+        # retries are done here, with backoff, not by the transport
+        es = AsyncElasticsearch([f"{host}:{port}"], max_retries=0)
+
+    pending = deque()
+    try:
+        async for batch in _abatches(texts, batch_size, max_chars):
+            batch = [_preprocess(s, lang, drop_punctuation) for s in batch]
+            pending.append(
+                asyncio.ensure_future(
+                    _analyze_batch_async(es, lang, batch, retries, backoff)
+                )
+            )
+            if len(pending) >= max_in_flight:
+                for t in await pending.popleft():
+                    yield t
+        while pending:
+            for t in await pending.popleft():
+                yield t
+    finally:
+        for task in pending:
+            task.cancel()
+        if own_client:
+            await es.close()
+
+
 if __name__ == "__main__":
     defopt.run([create_elasticsearch_indices])
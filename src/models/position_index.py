@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import tempfile
+from array import array
+from collections.abc import Mapping, Sequence
+from itertools import chain
+
+import numpy as np
+
+# On-disk index: magic, format version and header length, a JSON header
+# describing the arrays, then the raw arrays, each starting on a 64 byte
+# boundary so that they can be memory mapped in place.
+INDEX_MAGIC = b'WLSINDEX'
+INDEX_VERSION = 1
+_ALIGN = 64
+
+
+def _positions_dtype(tot_words):
+    if tot_words < np.iinfo(np.int32).max:
+        return np.int32
+    return np.int64
+
+
+class PositionIndex(Mapping):
+    '''Compact positional index of a tokenized text.
+
+    The positions of all words are kept in one integer array, grouped by
+    word and ascending within each word, with an offsets array marking where
+    each word starts (the CSR layout). Word i of `vocab` occurs at
+    positions[offsets[i]:offsets[i+1]].
+
+    The index behaves like the old dict of lists, word -> positions, except
+    that the positions come back as a read-only NumPy view.
+    '''
+    def __init__(self, vocab, positions, offsets):
+        self.vocab = list(vocab)
+        self.positions = np.asarray(positions)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self._word_ids = None
+
+    @classmethod
+    def from_token_ids(cls, vocab, token_ids, start=0):
+        '''Build the index from the sequence of word ids of a text.
+
+        `token_ids[k]` is the index into `vocab` of the token at position
+        start + k.
+        '''
+        token_ids = np.asarray(token_ids)
+        counts = np.bincount(token_ids, minlength=len(vocab))
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        # A stable sort keeps the positions of each word in text order.
+        dtype = _positions_dtype(start + len(token_ids))
+        positions = np.argsort(token_ids, kind='stable').astype(dtype)
+        positions += start
+        return cls(vocab, positions, offsets)
+
+    @classmethod
+    def from_dict(cls, word_pos):
+        '''Build the index from a dict of word -> list of positions.'''
+        vocab = list(word_pos.keys())
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum([len(word_pos[w]) for w in vocab], out=offsets[1:])
+        positions = np.fromiter(
+            chain.from_iterable(word_pos[w] for w in vocab),
+            dtype=np.int64, count=offsets[-1])
+        dtype = _positions_dtype(positions.max() + 1 if len(positions) else 0)
+        return cls(vocab, positions.astype(dtype), offsets)
+
+    @classmethod
+    def concatenate(cls, indexes):
+        '''Index of the texts of several indexes placed one after another.
+
+        Each index is shifted by the number of tokens before it, so the
+        result has the same vocabulary order and positions as indexing the
+        texts in sequence.
+        '''
+        vocab = []
+        word_ids = {}
+        words = []
+        positions = []
+        start = 0
+        for index in indexes:
+            remap = np.empty(len(index.vocab), dtype=np.int64)
+            for i, w in enumerate(index.vocab):
+                j = word_ids.get(w)
+                if j is None:
+                    j = word_ids[w] = len(vocab)
+                    vocab.append(w)
+                remap[i] = j
+            words.append(np.repeat(remap, index.counts))
+            positions.append(index.positions.astype(np.int64) + start)
+            start += index.tot_words
+
+        words = np.concatenate(words) if words else np.zeros(0, np.int64)
+        positions = np.concatenate(positions) if positions else words
+        counts = np.bincount(words, minlength=len(vocab))
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        # The texts are in order, so a stable sort by word keeps the
+        # positions of each word ascending.
+        order = np.argsort(words, kind='stable')
+        positions = positions[order].astype(_positions_dtype(start))
+        merged = cls(vocab, positions, offsets)
+        merged._word_ids = word_ids
+        return merged
+
+    @property
+    def word_ids(self):
+        if self._word_ids is None:
+            self._word_ids = {w: i for i, w in enumerate(self.vocab)}
+        return self._word_ids
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    @property
+    def tot_words(self):
+        return int(self.offsets[-1])
+
+    @property
+    def nbytes(self):
+        return self.positions.nbytes + self.offsets.nbytes
+
+    def __getitem__(self, word):
+        i = self.word_ids[word]
+        view = self.positions[self.offsets[i]:self.offsets[i+1]]
+        view.flags.writeable = False
+        return view
+
+    def __contains__(self, word):
+        return word in self.word_ids
+
+    def __iter__(self):
+        return iter(self.vocab)
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def token_ids(self):
+        '''Recover the word id of every position, the inverse of the index.
+
+        Positions are taken to run from 0 to tot_words - 1.
+        '''
+        token_ids = np.empty(self.tot_words, dtype=np.int32)
+        token_ids[self.positions] = np.repeat(
+            np.arange(len(self.vocab), dtype=np.int32), self.counts)
+        return token_ids
+
+
+def save_index(path, index, arrays=None, meta=None):
+    '''Write a PositionIndex, plus optional extra arrays and metadata.
+
+    The file is written next to path and moved over it when complete, so
+    processes that have the old file memory mapped keep reading it intact.
+    '''
+    text = ''.join(index.vocab)
+    vocab_offsets = np.zeros(len(index.vocab) + 1, dtype=np.int64)
+    np.cumsum([len(w) for w in index.vocab], out=vocab_offsets[1:])
+    arrays = dict(arrays or {})
+    arrays.update({
+        'positions': np.ascontiguousarray(index.positions),
+        'offsets': np.ascontiguousarray(index.offsets),
+        'vocab': np.frombuffer(text.encode('utf-8'), dtype=np.uint8),
+        'vocab_offsets': vocab_offsets,
+    })
+
+    layout = {}
+    offset = 0
+    for name, a in arrays.items():
+        layout[name] = {'dtype': a.dtype.str, 'shape': a.shape,
+                        'offset': offset}
+        offset += -(-a.nbytes // _ALIGN) * _ALIGN
+    header = json.dumps({'version': INDEX_VERSION, 'meta': meta or {},
+                         'arrays': layout}).encode('utf-8')
+    start = -(-(len(INDEX_MAGIC) + 8 + len(header)) // _ALIGN) * _ALIGN
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(INDEX_MAGIC)
+            fp.write(np.array([INDEX_VERSION, len(header)], '<u4').tobytes())
+            fp.write(header)
+            for name, a in arrays.items():
+                fp.seek(start + layout[name]['offset'])
+                fp.write(a.tobytes())
+            fp.truncate(start + offset)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def load_index(path, mmap=True):
+    '''Read a file written by save_index.
+
+    Returns (index, arrays, meta), where arrays holds the extra arrays.
+    With mmap=True the arrays are read-only np.memmap views of the file, so
+    opening is fast and processes loading the same file share its pages.
+    '''
+    with open(path, 'rb') as fp:
+        if fp.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError(f"Not a position index file: {path}")
+        version, size = np.frombuffer(fp.read(8), '<u4').tolist()
+        if version != INDEX_VERSION:
+            raise ValueError(f"Unsupported index file version: {version}")
+        header = json.loads(fp.read(size).decode('utf-8'))
+        start = -(-(len(INDEX_MAGIC) + 8 + size) // _ALIGN) * _ALIGN
+
+        arrays = {}
+        for name, spec in header['arrays'].items():
+            dtype = np.dtype(spec['dtype'])
+            shape = tuple(spec['shape'])
+            if mmap and int(np.prod(shape)) > 0:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r',
+                                         offset=start + spec['offset'],
+                                         shape=shape)
+            else:
+                fp.seek(start + spec['offset'])
+                count = int(np.prod(shape))
+                arrays[name] = np.fromfile(fp, dtype=dtype,
+                                           count=count).reshape(shape)
+
+    text = arrays.pop('vocab').tobytes().decode('utf-8')
+    vocab_offsets = arrays.pop('vocab_offsets').tolist()
+    vocab = [text[a:b] for a, b in zip(vocab_offsets[:-1], vocab_offsets[1:])]
+    index = PositionIndex(vocab, arrays.pop('positions'),
+                          arrays.pop('offsets'))
+    return index, arrays, header['meta']
+
+
+class PositionIndexBuilder():
+    '''Accumulates tokens into an interned vocabulary and word id array.
+
+    Each distinct word is stored once; the text itself is kept as 4 byte
+    word ids until build() turns it into a PositionIndex. The ids are then
+    dropped, since the index holds the same information. Tokens added after
+    that are kept as ids of the text following the index (starting at
+    position `start`) and merged into it by the next build(), without
+    going back to the ids of the whole text.
+    '''
+    def __init__(self):
+        self.vocab = []
+        self.word_ids = {}
+        self.token_ids = array('i')
+        self._index = None
+
+    @classmethod
+    def from_index(cls, index):
+        '''Continue adding tokens to the text of an existing index.'''
+        builder = cls()
+        builder.vocab = list(index.vocab)
+        builder.word_ids = dict(index.word_ids)
+        builder._index = index
+        return builder
+
+    @property
+    def start(self):
+        '''Position of the first token in token_ids.'''
+        return self._index.tot_words if self._index is not None else 0
+
+    @property
+    def pos_counter(self):
+        return self.start + len(self.token_ids)
+
+    def add(self, tokens):
+        vocab = self.vocab
+        word_ids = self.word_ids
+        append = self.token_ids.append
+        for t in tokens:
+            i = word_ids.get(t)
+            if i is None:
+                i = word_ids[t] = len(vocab)
+                vocab.append(t)
+            append(i)
+
+    def build(self):
+        if self._index is None or len(self.token_ids) > 0:
+            token_ids = np.frombuffer(self.token_ids, dtype=np.int32)
+            index = PositionIndex.from_token_ids(self.vocab, token_ids,
+                                                 self.start)
+            if self._index is not None:
+                index = _merge_following(self._index, index)
+            index._word_ids = dict(self.word_ids)
+            self._index = index
+            del token_ids
+            self.token_ids = array('i')
+        return self._index
+
+
+def _merge_following(index, following):
+    '''Index of the text of `index` followed by that of `following`.
+
+    `following` has the vocabulary of `index` (possibly extended) and
+    positions after all those of `index`, so within each word the
+    positions of `index` come first and the two can be interleaved by
+    offsets alone, without sorting.
+    '''
+    n_words = len(following.vocab)
+    before = np.full(n_words + 1, index.offsets[-1], dtype=np.int64)
+    before[:len(index.offsets)] = index.offsets
+    after = following.offsets
+    offsets = before + after
+
+    total = int(offsets[-1])
+    positions = np.empty(total, dtype=_positions_dtype(total))
+    # Positions of word w move up by the number of following positions of
+    # the words before it; following positions by those of `index` up to
+    # and including w.
+    counts = np.diff(before)
+    positions[np.arange(index.tot_words) + np.repeat(after[:-1], counts)] = \
+        index.positions
+    positions[np.arange(len(following.positions))
+              + np.repeat(before[1:], np.diff(after))] = following.positions
+    return PositionIndex(following.vocab, positions, offsets)
+
+
+class TokenSequence(Sequence):
+    '''Read-only view of a text as a sequence of token strings.
+
+    Stores the word id of every token and decodes on access, so slices and
+    indexing behave like the list of tokens they replace.
+    '''
+    def __init__(self, vocab, token_ids):
+        self.vocab = vocab
+        self.token_ids = token_ids
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [self.vocab[i] for i in self.token_ids[n]]
+        return self.vocab[self.token_ids[n]]
+
+    def __iter__(self):
+        # A generator method, so that iterating keeps the sequence alive.
+        vocab = self.vocab
+        for i in self.token_ids:
+            yield vocab[i]
+
+    def __len__(self):
+        return len(self.token_ids)
@@ -1,10 +1,28 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
+import inspect
+import os
+import time
 import numpy as np
-from scipy import stats
-from collections import Counter, defaultdict
+from array import array
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from multiprocessing import shared_memory
 
 import hdbscan
+from scipy import sparse
+from hdbscan._hdbscan_linkage import label as single_linkage_label
+from hdbscan._hdbscan_linkage import mst_linkage_core_vector
+from hdbscan.dist_metrics import DistanceMetric
+from hdbscan.hdbscan_ import _tree_to_labels
+from sklearn.decomposition import PCA
+from sklearn.neighbors import KDTree
+from sklearn.random_projection import GaussianRandomProjection
+
+from .WordLevelStatistics import score_at_percentile
+from .cluster_cache import ClusterCache
 
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -13,6 +31,308 @@ formatter = logging.Formatter('%(asctime)s %(message)s', '%b-%d-%Y %H:%M:%S')
 logger.handlers[0].setFormatter(formatter)
 
 
+# Data matrix of the parameter search, attached in each worker process
+# and kept open for the life of the worker.
+_SHARED_BLOCK = None
+_SHARED_X = None
+
+
+def _attach_shared_matrix(name, shape, dtype):
+    global _SHARED_BLOCK, _SHARED_X
+    _SHARED_BLOCK = shared_memory.SharedMemory(name=name)
+    _SHARED_X = np.ndarray(shape, dtype=dtype, buffer=_SHARED_BLOCK.buf)
+
+
+def _core_distances(X, min_samples_values):
+    '''Core distances for every min_samples from one neighbour query.
+
+    The distance to the k-th neighbour is the k-th column of a query for
+    the largest k, so the kNN graph is only built once.
+    '''
+    tree = KDTree(X, metric='minkowski', leaf_size=40)
+    k_max = max(min_samples_values)
+    distances = tree.query(X, k=k_max + 1, dualtree=True,
+                           breadth_first=True)[0]
+    return {s: distances[:, s].copy(order='C') for s in min_samples_values}
+
+
+def _single_linkage_tree(X, core_distances):
+    '''Single linkage tree of the mutual reachability graph of X.
+
+    The steps are those of hdbscan.hdbscan with algorithm='prims_kdtree',
+    which is what it picks for term vectors of more than 60 dimensions.
+    '''
+    min_spanning_tree = mst_linkage_core_vector(
+        X, core_distances, DistanceMetric.get_metric('minkowski'), 1.0)
+    min_spanning_tree = min_spanning_tree[
+        np.argsort(min_spanning_tree.T[2]), :]
+    return single_linkage_label(min_spanning_tree)
+
+
+def _row_labels(X, core_distances, sizes, cluster_selection_method):
+    '''Labels for every min_cluster_size in sizes, for one min_samples.
+
+    The mutual reachability graph, its minimum spanning tree and the single
+    linkage tree only depend on min_samples (through the core distances),
+    so they are built once and only the condensing and cluster selection
+    are repeated for each min_cluster_size.
+
+    Returns a (labels, seconds) pair per size; the time to build the tree
+    is counted in the first one.
+    '''
+    start = time.perf_counter()
+    single_linkage_tree = _single_linkage_tree(X, core_distances)
+    row = []
+    for min_cluster_size in sizes:
+        labels = _tree_to_labels(X, single_linkage_tree, min_cluster_size,
+                                 cluster_selection_method)[0]
+        end = time.perf_counter()
+        row.append((labels, end - start))
+        start = end
+    return row
+
+
+def _row_labels_shared(args):
+    return _row_labels(_SHARED_X, *args)
+
+
+def _effective_min_samples(n, ranges):
+    # As in hdbscan.hdbscan, min_samples is at most the number of other
+    # points.
+    return {s: max(1, min(n - 1, s)) for s in ranges}
+
+
+def _map_grid(X, sizes, ranges, cluster_selection_method, n_jobs):
+    '''Labels for every (min_cluster_size, min_samples) pair of the grid.
+
+    One single linkage tree is built per min_samples, see _row_labels.
+    With n_jobs > 1 (or -1 for all cores) the min_samples rows are spread
+    over a process pool. X is copied once into shared memory, which the
+    workers attach to, instead of being pickled with every task.
+
+    Returns a dict of (min_cluster_size, min_samples) -> (labels, seconds).
+    '''
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    effective = _effective_min_samples(len(X), ranges)
+    core_distances = _core_distances(X, set(effective.values()))
+    tasks = [(core_distances[effective[s]], sizes, cluster_selection_method)
+             for s in ranges]
+
+    if n_jobs is None or n_jobs == 1:
+        rows = [_row_labels(X, *task) for task in tasks]
+    else:
+        block = shared_memory.SharedMemory(create=True,
+                                           size=max(X.nbytes, 1))
+        try:
+            np.ndarray(X.shape, dtype=X.dtype, buffer=block.buf)[:] = X
+            with ProcessPoolExecutor(
+                    max_workers=None if n_jobs < 0 else n_jobs,
+                    initializer=_attach_shared_matrix,
+                    initargs=(block.name, X.shape, X.dtype)) as executor:
+                rows = list(executor.map(_row_labels_shared, tasks))
+        finally:
+            block.close()
+            block.unlink()
+
+    return {(c, s): result
+            for s, row in zip(ranges, rows)
+            for c, result in zip(sizes, row)}
+
+
+def _label_max(labels):
+    '''Highest cluster label, or None if every point is noise.'''
+    label_max = labels.max() if len(labels) else -1
+    return int(label_max) if label_max >= 0 else None
+
+
+def _log_evaluation(min_cluster_size, min_samples, label_max, seconds):
+    logging.info('min_cluster_size = %d, min_samples = %d: label_max = %s '
+                 '(%.3fs)', min_cluster_size, min_samples, label_max, seconds)
+
+
+class SearchBudgetExceeded(Exception):
+    pass
+
+
+class ParameterEvaluator():
+    '''Runs HDBSCAN for single (min_cluster_size, min_samples) pairs.
+
+    Calling the evaluator with a pair returns label_max for it (None if
+    every point is noise). The kNN graph is built once for the largest
+    min_samples in `ranges` and the single linkage tree once per
+    min_samples, as in the grid search. Each evaluation is logged with its
+    cost in seconds, and results are kept, so asking for the same pair
+    again is free.
+
+    With max_evaluations or max_seconds (counted from construction, so the
+    kNN query is included) a new evaluation past the budget raises
+    SearchBudgetExceeded.
+    '''
+    def __init__(self, X, ranges, cluster_selection_method='leaf',
+                 max_evaluations=None, max_seconds=None):
+        self.started = time.perf_counter()
+        self.X = np.ascontiguousarray(X, dtype=np.float64)
+        self.cluster_selection_method = cluster_selection_method
+        self.max_evaluations = max_evaluations
+        self.max_seconds = max_seconds
+        self.labels = {}
+        self.costs = {}
+        self._effective = _effective_min_samples(len(self.X), ranges)
+        self._core_distances = _core_distances(
+            self.X, set(self._effective.values()))
+        self._trees = {}
+
+    @property
+    def n_evaluations(self):
+        return len(self.labels)
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def exhausted(self):
+        if self.max_evaluations is not None \
+                and self.n_evaluations >= self.max_evaluations:
+            return True
+        return self.max_seconds is not None \
+            and self.elapsed >= self.max_seconds
+
+    def __call__(self, min_cluster_size, min_samples):
+        key = (min_cluster_size, min_samples)
+        if key not in self.labels:
+            if self.exhausted:
+                raise SearchBudgetExceeded(
+                    f'{self.n_evaluations} evaluations in '
+                    f'{self.elapsed:.1f}s')
+            start = time.perf_counter()
+            s = self._effective[min_samples]
+            if s not in self._trees:
+                self._trees[s] = _single_linkage_tree(
+                    self.X, self._core_distances[s])
+            labels = _tree_to_labels(self.X, self._trees[s],
+                                     min_cluster_size,
+                                     self.cluster_selection_method)[0]
+            self.labels[key] = labels
+            self.costs[key] = time.perf_counter() - start
+            _log_evaluation(*key, _label_max(labels), self.costs[key])
+        return _label_max(self.labels[key])
+
+
+def _search_score(label_max, target_label_min, target_label_max):
+    # Pairs within the target range rank above all others, by label_max;
+    # the rest rank by their distance to the range.
+    if label_max is None:
+        return (0, -np.inf)
+    if target_label_min <= label_max <= target_label_max:
+        return (1, label_max)
+    return (0, -max(target_label_min - label_max,
+                    label_max - target_label_max))
+
+
+def grid_search(evaluate, sizes, ranges, target_label_min, target_label_max):
+    '''Evaluate every pair of the grid, min_cluster_size outermost.'''
+    for c in sizes:
+        for s in ranges:
+            evaluate(c, s)
+
+
+def _coarse_indices(n, step):
+    return sorted(set(range(0, n, step)) | {n - 1})
+
+
+def _new_neighbours(ij, step, shape, visited):
+    '''Grid neighbours of ij at distance step not visited yet.'''
+    neighbours = [(ij[0] + di, ij[1] + dj)
+                  for di in (-step, 0, step) for dj in (-step, 0, step)]
+    return [(i, j) for i, j in neighbours
+            if 0 <= i < shape[0] and 0 <= j < shape[1]
+            and (i, j) not in visited]
+
+
+def coarse_to_fine_search(evaluate, sizes, ranges, target_label_min,
+                          target_label_max, step=None):
+    '''Evaluate a coarse sub-grid, then refine around the best pair.
+
+    The coarse pass takes every `step`-th value of both parameters
+    (by default about four values of each). Then, with the step halved
+    each round down to 1, the neighbours of the best pair so far are
+    evaluated. Pairs within the target label range rank first, by
+    label_max, and the others by how far they are from it.
+
+    The search stops once the best pair is within the target range and
+    none of its direct neighbours is better, once it reaches
+    target_label_max (which cannot be improved on), or when the
+    evaluator's budget runs out.
+    '''
+    sizes, ranges = list(sizes), list(ranges)
+    if step is None:
+        step = max(1, (max(len(sizes), len(ranges)) - 1) // 3)
+    scores = {}
+
+    def visit(i, j):
+        if (i, j) not in scores:
+            scores[(i, j)] = _search_score(evaluate(sizes[i], ranges[j]),
+                                           target_label_min,
+                                           target_label_max)
+
+    for i, j in product(_coarse_indices(len(sizes), step),
+                        _coarse_indices(len(ranges), step)):
+        visit(i, j)
+
+    while True:
+        # Ties go to the pair that comes last in grid order, as in the
+        # exhaustive search.
+        best = max(scores, key=lambda ij: (scores[ij], ij))
+        if scores[best] == (1, target_label_max):
+            return
+        step = max(1, step // 2)
+        neighbours = _new_neighbours(best, step, (len(sizes), len(ranges)),
+                                     scores)
+        if not neighbours:
+            if step == 1:
+                return
+            continue
+        for i, j in neighbours:
+            visit(i, j)
+
+
+SEARCH_STRATEGIES = {
+    'grid': grid_search,
+    'coarse_to_fine': coarse_to_fine_search,
+}
+
+
+def _evaluate_pairs(X, sizes, ranges, target_label_min, target_label_max,
+                    cluster_selection_method, n_jobs, strategy,
+                    max_evaluations, max_seconds):
+    '''Labels of the pairs tried, a dict (min_cluster_size, min_samples)
+    -> labels.'''
+    if strategy == 'grid' and max_evaluations is None \
+            and max_seconds is None:
+        # Without a budget the whole grid is run up front, in parallel
+        # with n_jobs.
+        all_labels = {}
+        for key, (labels, seconds) in _map_grid(
+                X, sizes, ranges, cluster_selection_method, n_jobs).items():
+            _log_evaluation(*key, _label_max(labels), seconds)
+            all_labels[key] = labels
+        return all_labels
+
+    search = SEARCH_STRATEGIES.get(strategy, strategy)
+    evaluate = ParameterEvaluator(X, ranges, cluster_selection_method,
+                                  max_evaluations, max_seconds)
+    try:
+        search(evaluate, sizes, ranges, target_label_min, target_label_max)
+    except SearchBudgetExceeded as ex:
+        logging.info('Search budget exhausted after %s', ex)
+        if not evaluate.labels:
+            raise
+    logging.info('%d evaluations in %.3fs', evaluate.n_evaluations,
+                 evaluate.elapsed)
+    return evaluate.labels
+
+
 def hdbscan_parameter_search(
                                 X,
                                 min_cluster_size_min=4,
@@ -21,12 +341,22 @@ def hdbscan_parameter_search(
                                 min_samples_max=10,
                                 target_label_min=5,
                                 target_label_max=260,
-                                cluster_selection_method='leaf'
+                                cluster_selection_method='leaf',
+                                n_jobs=1,
+                                strategy='grid',
+                                max_evaluations=None,
+                                max_seconds=None
                             ):
-    # Brute force over combinations.
+    # `strategy` is a name in SEARCH_STRATEGIES or a function
+    # strategy(evaluate, sizes, ranges, target_label_min, target_label_max)
+    # that calls evaluate(min_cluster_size, min_samples) for the pairs it
+    # wants to try. The best pair among those evaluated is returned; if
+    # none is within the target range, the one closest to it (see
+    # _search_score). SearchBudgetExceeded is raised if the budget does not
+    # allow a single evaluation.
     sizes = range(min_cluster_size_min, min_cluster_size_max)
     ranges = range(min_samples_min, min_samples_max)
-    all_combinations = ((c, s) for c in sizes for s in ranges)
+    all_combinations = [(c, s) for c in sizes for s in ranges]
 
     logging.info('Searching for clusters with: %d <= label_max <= %d',
                  target_label_min, target_label_max)
@@ -34,15 +364,17 @@ def hdbscan_parameter_search(
     label_values = []
     cluster_bincounts = []
 
-    # Calculate results of hdbscan for every combination, save results.
-    for min_cluster_size, min_samples in all_combinations:
-        labels, *rest = hdbscan.hdbscan(
-                            X,
-                            approx_min_span_tree=False,
-                            cluster_selection_method=cluster_selection_method,
-                            min_cluster_size=min_cluster_size,
-                            min_samples=min_samples
-                        )
+    # Calculate results of hdbscan for the combinations tried, save results.
+    all_labels = _evaluate_pairs(X, sizes, ranges, target_label_min,
+                                 target_label_max, cluster_selection_method,
+                                 n_jobs, strategy, max_evaluations,
+                                 max_seconds)
+
+    # Results are read back in grid order, so ties are broken the same way
+    # whatever order the pairs were evaluated in.
+    tried = [key for key in all_combinations if key in all_labels]
+    for min_cluster_size, min_samples in tried:
+        labels = all_labels[(min_cluster_size, min_samples)]
         true_labels = [label for label in labels if label != -1]
         try:
             label_max = np.max(true_labels)
@@ -55,15 +387,25 @@ def hdbscan_parameter_search(
             cluster_params.append((min_cluster_size, min_samples))
             cluster_bincounts.append(np.bincount(true_labels))
 
+    if not label_values:
+        # Nothing in the target range (common with a budget): settle for
+        # the pair closest to it, the last in grid order among equals.
+        label_maxes = {key: _label_max(all_labels[key]) for key in tried}
+        best = max(reversed(tried), key=lambda key: _search_score(
+            label_maxes[key], target_label_min, target_label_max))
+        logging.warning('No pair in the target range, using label_max = %s,'
+                        ' min_cluster_size = %d, min_samples = %d',
+                        label_maxes[best], *best)
+        return best
+
     label_values = list(reversed(label_values))
     cluster_params = list(reversed(cluster_params))
     cluster_bincounts = list(reversed(cluster_bincounts))
 
     # Select a solution of the clustering problem that has the most clusters.
-    if len(label_values) > 0:
-        i = np.argmax(label_values)
-        min_cluster_size_opt, min_samples_opt = cluster_params[i]
-        label_max = label_values[i]
+    i = np.argmax(label_values)
+    min_cluster_size_opt, min_samples_opt = cluster_params[i]
+    label_max = label_values[i]
 
     # Print out all the solutions with the max number of clusters.
     for i, label in enumerate(label_values):
@@ -80,22 +422,79 @@ def hdbscan_parameter_search(
     return min_cluster_size_opt, min_samples_opt
 
 
-def enumerate_exemplars(clusterer, X):
-    points = []
-    ex_no = []
-    for n, ex in enumerate(clusterer.exemplars_):
-        ex_points = []
-        for point in ex:
-            points.append(point)
-            ex_points.append(point)
-            ex_no.append(n)
+# Search parameters that make up a cache key, with their defaults.
+_SEARCH_DEFAULTS = {
+    name: p for name, p in
+    inspect.signature(hdbscan_parameter_search).parameters.items()
+    if name not in ('X', 'cluster_selection_method', 'n_jobs')}
+
 
+def exemplar_rows(clusterer, X, rtol=1e-05, atol=1e-08):
+    '''Rows of X that are exemplars of a fitted HDBSCAN clusterer.
+
+    Returns (rows, clusters): the ascending row indices of X and, for each,
+    the number of the cluster (the index into clusterer.exemplars_) it is an
+    exemplar of.
+
+    The exemplars are copies of rows of X, so they are matched by their
+    bytes in one sorted lookup. An exemplar with no identical row is
+    looked up with a KD-tree instead and matched to the rows that are
+    np.allclose to it with the given tolerances.
+    '''
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    exemplars = clusterer.exemplars_
+    if len(exemplars) == 0 or len(X) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    points = np.ascontiguousarray(np.concatenate(exemplars),
+                                  dtype=np.float64)
+    point_clusters = np.repeat(np.arange(len(exemplars)),
+                               [len(ex) for ex in exemplars])
+
+    # One opaque item per row, so that rows compare by their bytes.
+    row_type = np.dtype((np.void, X.dtype.itemsize * X.shape[1]))
+    X_keys = X.view(row_type).ravel()
+    point_keys = points.view(row_type).ravel()
+    order = np.argsort(point_keys, kind='stable')
+    sorted_keys = point_keys[order]
+    found = np.searchsorted(sorted_keys, X_keys)
+    found[found == len(sorted_keys)] = 0
+    matched = sorted_keys[found] == X_keys
+    row_clusters = np.full(len(X), -1, dtype=np.int64)
+    row_clusters[matched] = point_clusters[order[found[matched]]]
+
+    unmatched = np.ones(len(points), dtype=bool)
+    unmatched[order[np.unique(found[matched])]] = False
+    if unmatched.any():
+        tree = KDTree(X)
+        for p, n in zip(points[unmatched], point_clusters[unmatched]):
+            # Every row within the allclose tolerance lies inside this
+            # ball; the candidates are then checked element-wise.
+            tol = atol + rtol * np.abs(p)
+            radius = np.sqrt(np.sum(tol * tol))
+            candidates = tree.query_radius(p[None, :], radius)[0]
+            close = np.all(np.abs(X[candidates] - p) <= tol, axis=1)
+            rows = candidates[close]
+            rows = rows[row_clusters[rows] == -1]
+            row_clusters[rows] = n
+
+    rows = np.flatnonzero(row_clusters >= 0)
+    return rows, row_clusters[rows]
+
+
+def enumerate_exemplars(clusterer, X, return_indices=False):
+    '''Mark the exemplars of a fitted HDBSCAN clusterer among the rows of X.
+
+    Returns a list with '*' for the exemplar rows and '' for the others.
+    With return_indices the exemplar row indices and cluster numbers of
+    exemplar_rows are returned as well.
+    '''
+    rows, clusters = exemplar_rows(clusterer, X)
     exemplars = ['']*len(X)
-    for n, v in enumerate(X):
-        for p in points:
-            if np.allclose(v, p):
-                exemplars[n] = '*'
+    for n in rows.tolist():
+        exemplars[n] = '*'
 
+    if return_indices:
+        return exemplars, rows, clusters
     return exemplars
 
 
@@ -115,16 +514,99 @@ def topic_order_index(topic_list):
     return per_topic_index
 
 
-def filter_enrich_significant_terms(df, percentile_C,
-                                    cluster_selection_method):
-    # Find topic clusters for the data after applying threshhold
-    # corresponding to desired percentile.
-    threshold = stats.scoreatpercentile(df['C'], percentile_C)
-    significant_terms_filtered = df[df['C'] > threshold].copy()
+def pack_vectors(vectors, dtype=np.float32):
+    '''Pack a sequence of term vectors into one C-contiguous matrix.
+
+    `vectors` is e.g. the 'vector' column of a level statistics frame; a
+    2-D array is converted without going through a list of rows.
+    '''
+    if isinstance(vectors, np.ndarray) and vectors.ndim == 2:
+        return np.ascontiguousarray(vectors, dtype=dtype)
+    vectors = list(vectors)
+    if not vectors:
+        return np.zeros((0, 0), dtype=dtype)
+    X = np.empty((len(vectors), len(vectors[0])), dtype=dtype)
+    for n, v in enumerate(vectors):
+        X[n] = v
+    return X
+
+
+# Results of reduce_dimensions, most recently used last.
+_REDUCTION_CACHE = OrderedDict()
+_REDUCTION_CACHE_SIZE = 8
+
+
+def reduce_dimensions(X, n_components, method='pca', random_state=0):
+    '''Project the rows of X onto n_components dimensions.
+
+    method is 'pca' or 'random_projection' (a Gaussian random projection).
+    The result is float32 and read-only. The last few results are cached
+    by the bytes of X and the parameters, so repeated runs on the same
+    terms, e.g. with a different percentile_C or selection method
+    downstream, do not refit.
+    '''
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    key = (hashlib.sha1(X).hexdigest(), X.shape, method, n_components,
+           random_state)
+    if key in _REDUCTION_CACHE:
+        _REDUCTION_CACHE.move_to_end(key)
+        return _REDUCTION_CACHE[key]
+
+    if method == 'pca':
+        reducer = PCA(n_components=n_components, random_state=random_state)
+    elif method == 'random_projection':
+        reducer = GaussianRandomProjection(n_components=n_components,
+                                           random_state=random_state)
+    else:
+        raise ValueError(f"Unknown reduction method: {method}")
+    reduced = np.ascontiguousarray(reducer.fit_transform(X),
+                                   dtype=np.float32)
+    reduced.flags.writeable = False
+
+    _REDUCTION_CACHE[key] = reduced
+    if len(_REDUCTION_CACHE) > _REDUCTION_CACHE_SIZE:
+        _REDUCTION_CACHE.popitem(last=False)
+    return reduced
+
+
+def _cluster_matrix(vectors, n_components, reduction):
+    # The matrix the density clustering runs on: the term vectors packed
+    # once, and optionally reduced.
+    X = pack_vectors(vectors)
+    if n_components is not None and n_components < X.shape[1]:
+        X = reduce_dimensions(X, n_components, reduction)
+    return X
+
+
+def _cluster_terms(X, cluster_selection_method, cache=None,
+                   search_params=None, **key_params):
+    '''Parameter search, fit and exemplars for the rows of X.
+
+    Returns (labels, exemplars, (min_cluster_size, min_samples)). With a
+    cache (a ClusterCache, or a directory for one) the result is looked up
+    by X, cluster_selection_method, the search parameters and key_params,
+    and only computed and stored on a miss.
+    '''
+    search_params = {
+        **{name: p.default for name, p in _SEARCH_DEFAULTS.items()},
+        **(search_params or {}),
+        'cluster_selection_method': cluster_selection_method}
+    if cache is not None:
+        if not isinstance(cache, ClusterCache):
+            cache = ClusterCache(cache)
+        key = cache.key(X, **{k: v for k, v in search_params.items()
+                              if k != 'n_jobs'}, **key_params)
+        entry = cache.get(key)
+        if entry is not None:
+            arrays, meta = entry
+            logging.info('Using cached clusters %s', key[:12])
+            exemplars = ['']*len(X)
+            for n in arrays['exemplar_rows'].tolist():
+                exemplars[n] = '*'
+            return arrays['labels'], exemplars, tuple(meta['params'])
 
-    X = list(significant_terms_filtered['vector'])
-    min_cluster_size_opt, min_samples_opt = hdbscan_parameter_search(
-        X, cluster_selection_method=cluster_selection_method)
+    params = hdbscan_parameter_search(X, **search_params)
+    min_cluster_size_opt, min_samples_opt = params
 
     clusterer = hdbscan.HDBSCAN(
         min_cluster_size=min_cluster_size_opt,
@@ -132,9 +614,35 @@ def filter_enrich_significant_terms(df, percentile_C,
         approx_min_span_tree=False,
         cluster_selection_method=cluster_selection_method)
     labels = clusterer.fit_predict(X)
+    exemplars, rows, clusters = enumerate_exemplars(clusterer, X,
+                                                    return_indices=True)
+
+    if cache is not None:
+        cache.put(key, {'labels': labels, 'exemplar_rows': rows,
+                        'exemplar_clusters': clusters},
+                  {'params': [int(p) for p in params]})
+    return labels, exemplars, params
+
+
+def filter_enrich_significant_terms(df, percentile_C,
+                                    cluster_selection_method,
+                                    n_components=None, reduction='pca',
+                                    cache=None, search_params=None):
+    # Find topic clusters for the data after applying threshhold
+    # corresponding to desired percentile.
+    threshold = score_at_percentile(df['C'], percentile_C)
+    significant_terms_filtered = df[df['C'] > threshold].copy()
+
+    # With n_components the vectors are reduced (see reduce_dimensions)
+    # before the parameter search and the fit. search_params are passed on
+    # to hdbscan_parameter_search; with a cache, see _cluster_terms.
+    X = _cluster_matrix(significant_terms_filtered['vector'], n_components,
+                        reduction)
+    labels, exemplars, _ = _cluster_terms(
+        X, cluster_selection_method, cache, search_params,
+        percentile_C=percentile_C)
     significant_terms_filtered['topic'] = labels
 
-    exemplars = enumerate_exemplars(clusterer, X)
     significant_terms_filtered['exemplar'] = exemplars
     significant_terms_filtered['word*'] = (
         significant_terms_filtered['word'] +
@@ -146,6 +654,53 @@ def filter_enrich_significant_terms(df, percentile_C,
     return significant_terms_filtered
 
 
+def _topic_weight_matrix(topic_model, significant_terms):
+    '''Term lookup and word x topic weight matrix for message_topics.
+
+    `lookup` maps every significant term to its row of the sparse weight
+    matrix, or to -1 if the topic model does not have it; such terms still
+    count towards a sentence's number of significant terms. Row j of the
+    matrix holds the weight of term j in the column of its topic, and is
+    empty for noise (topic -1). Repeated words take their last row in the
+    topic model.
+    '''
+    K = int(topic_model['topic'].max())
+    words = list(topic_model['word'])
+    row_of = {w: j for j, w in enumerate(words)}
+    lookup = {w: row_of.get(w, -1) for w in set(significant_terms)}
+
+    rows = np.fromiter(row_of.values(), dtype=np.int64, count=len(row_of))
+    topics = np.asarray(topic_model['topic'], dtype=np.int64)[rows]
+    weights = np.asarray(topic_model['weight'], dtype=np.float64)[rows]
+    keep = (topics >= 0) & (topics <= K)
+    weight_matrix = sparse.csr_matrix(
+        (weights[keep], (rows[keep], topics[keep])),
+        shape=(len(words), K + 1))
+    return lookup, weight_matrix
+
+
+def _sentence_topics(lookup, weight_matrix, sentences):
+    '''Dense sentences x topics weights, see message_topics.'''
+    term_ids = array('q')
+    indptr = array('q', [0])
+    n_terms = array('q')
+    for text in sentences:
+        ids = [lookup[w] for w in text.split() if w in lookup]
+        n_terms.append(len(ids))
+        term_ids.extend(j for j in ids if j >= 0)
+        indptr.append(len(term_ids))
+
+    term_ids = np.frombuffer(term_ids, dtype=np.int64)
+    doc_term = sparse.csr_matrix(
+        (np.ones(len(term_ids)), term_ids, np.frombuffer(indptr, np.int64)),
+        shape=(len(n_terms), weight_matrix.shape[0]))
+    topic_weights = (doc_term @ weight_matrix).toarray()
+    n_terms = np.frombuffer(n_terms, dtype=np.int64)
+    has_terms = n_terms > 0
+    topic_weights[has_terms] /= n_terms[has_terms, None]
+    return topic_weights
+
+
 def message_topics(topic_model=None, sentences=None,
                    sentences_ids=None, significant_terms=None):
     ''' Cacluate the distribution of term weights in each sentence.
@@ -153,88 +708,104 @@ def message_topics(topic_model=None, sentences=None,
         weight, and topic number. Expects lists of sentences and their
         corresponding ids. The significant terms are used to further
         restrict the terms.
+
+        Returns (doc_ids, topic_weights), where row n of the dense
+        len(sentences) x (K+1) array is the weight of each topic 0..K in
+        sentence doc_ids[n]: the sum of the weights of its terms in that
+        topic, divided by its number of significant terms (counting
+        repeats). It is computed as a sparse sentence x term count matrix
+        times a sparse term x topic weight matrix.
     '''
-    K = topic_model['topic'].max()
-    message_topics = {}
+    sentences = list(sentences)
+    if sentences_ids is None:
+        sentences_ids = range(len(sentences))
+    doc_ids = _object_array(list(sentences_ids))
 
-    # Simple maps for convenicence.
-    wt = list(zip(list(topic_model['word']), list(topic_model['topic'])))
-    word_to_topic = {}
-    for w, t in wt:
-        word_to_topic[w] = t
+    lookup, weight_matrix = _topic_weight_matrix(topic_model,
+                                                 significant_terms)
+    return doc_ids, _sentence_topics(lookup, weight_matrix, sentences)
 
-    def map_word_to_topic(w):
-        try:
-            t = word_to_topic[w]
-        except Exception as ex:
-            t = ''
-        return (w, t)
 
-    ww = list(zip(list(topic_model['word']), list(topic_model['weight'])))
-    word_to_weight = {}
-    for w, t in ww:
-        word_to_weight[w] = t
+# Term lookup and weight matrix of iter_message_topics, sent once to each
+# worker process.
+_TOPIC_LOOKUP = None
+_TOPIC_WEIGHTS = None
 
-    def map_word_to_weight(w):
-        try:
-            wt = word_to_weight[w]
-        except Exception as ex:
-            wt = 0.0
-        return (w, wt)
-
-    def terms_to_topics(terms=None):
-        topic_vector = defaultdict(list)
-        word_topic_list = list(map(map_word_to_topic, terms))
-        for k, v in word_topic_list:
-            topic_vector[v].append(k)
-        return [len(topic_vector[n]) for n in range(1, K+1)]
-
-    def terms_to_weights(terms=None, topic_no=1, doc_id=None):
-        weight_vector = {}
-        for w in significant_words:
-            if w in word_to_weight:
-                for t in range(0, K+1):
-                    if w in word_to_topic:
-                        if word_to_topic[w] == t:
-                            if t in weight_vector:
-                                # print(t,weight_vector)
-                                if len(terms) > 0:
-                                    weight_vector[t] += word_to_weight[w]/len(terms)
-                                else:
-                                    weight_vector[t] += word_to_weight[w]
-                            else:
-                                if len(terms) > 0:
-                                    weight_vector[t] = word_to_weight[w]/len(terms)
-                                else:
-                                    weight_vector[t] = word_to_weight[w]
-
-        weight_vector['doc_id'] = doc_id
-        return weight_vector
-
-    for doc_id, message_txt in list(zip(sentences_ids, sentences)):
-        words = message_txt.split()
-        significant_words = [w for w in words if w in significant_terms]
-        message_topics[doc_id] = terms_to_weights(terms=significant_words,
-                                                  doc_id=doc_id)
-        # message_topics[doc_id] = terms_to_topics(terms=significant_words)
-
-    return message_topics
-
-
-def enrich_significant_terms(significant_terms, vec, vec_2d, cluster_method):
+
+def _set_topic_model(lookup, weight_matrix):
+    global _TOPIC_LOOKUP, _TOPIC_WEIGHTS
+    _TOPIC_LOOKUP = lookup
+    _TOPIC_WEIGHTS = weight_matrix
+
+
+def _chunk_topics(chunk):
+    doc_ids, sentences = chunk
+    return doc_ids, _sentence_topics(_TOPIC_LOOKUP, _TOPIC_WEIGHTS,
+                                     sentences)
+
+
+def _chunks(messages, chunk_size):
+    doc_ids, sentences = [], []
+    for doc_id, text in messages:
+        doc_ids.append(doc_id)
+        sentences.append(text)
+        if len(sentences) == chunk_size:
+            yield _object_array(doc_ids), sentences
+            doc_ids, sentences = [], []
+    if sentences:
+        yield _object_array(doc_ids), sentences
+
+
+def _object_array(values):
+    a = np.empty(len(values), dtype=object)
+    a[:] = values
+    return a
+
+
+def iter_message_topics(topic_model, messages, significant_terms,
+                        chunk_size=10000, n_jobs=1):
+    '''Streaming message_topics over an iterable of (doc_id, text) pairs.
+
+    The messages are read chunk_size at a time and a (doc_ids,
+    topic_weights) pair is yielded per chunk, in input order, with the same
+    weights as message_topics. Only a bounded number of chunks are held at
+    once, so `messages` can be an unbounded stream.
+
+    With n_jobs > 1 (or -1 for all cores) chunks are scored in a process
+    pool; the topic model is sent to each worker once, and at most two
+    chunks per worker are in flight.
+    '''
+    lookup, weight_matrix = _topic_weight_matrix(topic_model,
+                                                 significant_terms)
+    chunks = _chunks(messages, chunk_size)
+    if n_jobs is None or n_jobs == 1:
+        for doc_ids, sentences in chunks:
+            yield doc_ids, _sentence_topics(lookup, weight_matrix, sentences)
+        return
+
+    max_workers = (os.cpu_count() or 1) if n_jobs < 0 else n_jobs
+    with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_set_topic_model,
+            initargs=(lookup, weight_matrix)) as executor:
+        in_flight = deque()
+        for chunk in chunks:
+            in_flight.append(executor.submit(_chunk_topics, chunk))
+            if len(in_flight) >= 2 * max_workers:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def enrich_significant_terms(significant_terms, vec, vec_2d, cluster_method,
+                             n_components=None, reduction='pca',
+                             cache=None, search_params=None):
     # Find topic clusters for the data
-    min_cluster_size_opt, min_samples_opt = hdbscan_parameter_search(
-                          vec,
-                          cluster_selection_method=cluster_method)
-
-    clusterer = hdbscan.HDBSCAN(min_cluster_size=min_cluster_size_opt,
-                                min_samples=min_samples_opt,
-                                approx_min_span_tree=False,
-                                cluster_selection_method=cluster_method)
-    labels = clusterer.fit_predict(np.array(vec))
+    X = _cluster_matrix(vec, n_components, reduction)
+    labels, exemplars, _ = _cluster_terms(X, cluster_method, cache,
+                                          search_params)
     significant_terms['topic'] = labels
 
-    exemplars = enumerate_exemplars(clusterer, np.array(vec))
     significant_terms['exemplar'] = exemplars
     significant_terms['word*'] = (significant_terms['word'] +
                                   significant_terms['exemplar'])
@@ -3,7 +3,7 @@ import plotly.graph_objs as go
 
 def word_distributions(word_list=None, word_level_statistics=None):
     positions = [word_level_statistics.word_pos[word] for word in word_list]
-    keywords_in_context = [' '.join(word_level_statistics.tokens[n-2:n+3]) for n,w in enumerate(word_level_statistics.tokens)]
+    tokens = word_level_statistics.tokens
 
     word_list.reverse()
     positions.reverse()
@@ -15,7 +15,7 @@ def word_distributions(word_list=None, word_level_statistics=None):
         scatter.marker.symbol = 'line-ns-open'
         scatter.marker.color = 'grey'
         scatter.name = w
-        scatter.hovertext = [keywords_in_context[n] for n in p]
+        scatter.hovertext = [' '.join(tokens[n-2:n+3]) for n in p]
         scatter.hoverinfo = 'text'
 
     ticklabels = []
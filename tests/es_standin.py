@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the parts of elasticsearch that tokenize_async uses:
+the product check on / and _analyze, which splits texts on \\w+ and
+lowercases the tokens, with utf-16 offsets like elasticsearch
+"""
+
+import asyncio
+import re
+
+from aiohttp import web
+
+HEADERS = {"X-Elastic-Product": "Elasticsearch"}
+
+
+class AnalyzeStandIn:
+    """
+    Serves _analyze, answering every fail_every-th request with a 503,
+    after delay seconds. Counts requests, failures and the largest
+    number of requests in progress at once.
+    """
+
+    def __init__(self, fail_every: int = 5, delay: float = 0.01):
+        self.fail_every = fail_every
+        self.delay = delay
+        self.calls = 0
+        self.failures = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/", self.root)
+        app.router.add_route("*", "/{index}/_analyze", self.analyze)
+        return app
+
+    async def root(self, request):
+        return web.json_response(
+            {"version": {"number": "7.17.0", "build_flavor": "default"},
+             "tagline": "You Know, for Search"},
+            headers=HEADERS,
+        )
+
+    async def analyze(self, request):
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            body = await request.json()
+            await asyncio.sleep(self.delay)
+            if self.calls % self.fail_every == 0:
+                self.failures += 1
+                return web.json_response(
+                    {"error": "busy"}, status=503, headers=HEADERS
+                )
+            texts = body["text"]
+            if isinstance(texts, str):
+                texts = [texts]
+            return web.json_response(
+                {"tokens": _tokens(texts)}, headers=HEADERS
+            )
+        finally:
+            self.in_flight -= 1
+
+
+def _utf16_len(s: str) -> int:
+    return len(s.encode("utf-16-le")) // 2
+
+
+def _tokens(texts):
+    # texts are analyzed as one, each starting one position after the
+    # end of the previous
+    tokens = []
+    base = 0
+    for t in texts:
+        for m in re.finditer(r"\w+", t):
+            tokens.append({
+                "token": m.group().lower(),
+                "start_offset": base + _utf16_len(t[:m.start()]),
+                "end_offset": base + _utf16_len(t[:m.end()]),
+            })
+        base += _utf16_len(t) + 1
+    return tokens
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import hdbscan
+import numpy as np
+import pytest
+
+from src.models.utilities import (SearchBudgetExceeded, _map_grid,
+                                  hdbscan_parameter_search)
+
+# The grid search builds HDBSCAN's trees itself from private hdbscan
+# functions; its labels must stay those of hdbscan.hdbscan.
+SIZES = range(3, 7)
+RANGES = range(2, 6)
+
+
+def blobs():
+    rng = np.random.default_rng(0)
+    centers = rng.normal(scale=10, size=(6, 5))
+    return np.concatenate([c + rng.normal(size=(30, 5)) for c in centers])
+
+
+def test_grid_labels_match_hdbscan():
+    X = blobs()
+    grid = _map_grid(X, SIZES, RANGES, 'leaf', n_jobs=1)
+    for (c, s), (labels, _) in grid.items():
+        expected = hdbscan.hdbscan(X, min_cluster_size=c, min_samples=s,
+                                   cluster_selection_method='leaf',
+                                   algorithm='prims_kdtree',
+                                   approx_min_span_tree=False)[0]
+        np.testing.assert_array_equal(labels, expected, err_msg=str((c, s)))
+
+
+def test_budget_without_pair_in_range():
+    # One evaluation finds fewer clusters than target_label_min; the pair
+    # closest to the range is returned instead.
+    X = blobs()[:50]
+    assert hdbscan_parameter_search(X, max_evaluations=1) == (4, 4)
+    with pytest.raises(SearchBudgetExceeded):
+        hdbscan_parameter_search(X, max_evaluations=0)
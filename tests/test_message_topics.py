@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+
+from src.models.utilities import iter_message_topics, message_topics
+
+
+TOPIC_MODEL = pd.DataFrame({
+    'word': ['cat', 'dog', 'fish', 'bird', 'noise'],
+    'topic': [0, 0, 1, 2, -1],
+    'weight': [0.5, 0.25, 1.0, 2.0, 3.0],
+})
+SIGNIFICANT_TERMS = {'cat', 'dog', 'fish', 'bird', 'noise', 'unknown'}
+SENTENCES = [
+    'cat dog fish',
+    'cat cat unknown',
+    'nothing significant here',
+    'bird noise fish fish',
+    '',
+]
+IDS = ['a', 'b', 'c', 'd', 'e']
+
+
+def expected_weights():
+    # Sum of the term weights per topic, divided by the number of
+    # significant terms of the sentence (repeats and terms outside the
+    # topic model included, noise terms add no weight).
+    return np.array([
+        [(0.5 + 0.25) / 3, 1.0 / 3, 0],
+        [(0.5 + 0.5) / 3, 0, 0],
+        [0, 0, 0],
+        [0, 2.0 / 4, 2.0 / 4],
+        [0, 0, 0],
+    ])
+
+
+def test_message_topics():
+    doc_ids, weights = message_topics(TOPIC_MODEL, SENTENCES, IDS,
+                                      SIGNIFICANT_TERMS)
+    assert list(doc_ids) == IDS
+    assert weights.shape == (len(SENTENCES), 3)
+    np.testing.assert_allclose(weights, expected_weights(), atol=1e-15)
+
+
+def test_iter_message_topics_matches_message_topics():
+    chunks = list(iter_message_topics(TOPIC_MODEL, zip(IDS, SENTENCES),
+                                      SIGNIFICANT_TERMS, chunk_size=2))
+    assert [len(ids) for ids, _ in chunks] == [2, 2, 1]
+    doc_ids = np.concatenate([ids for ids, _ in chunks])
+    weights = np.vstack([w for _, w in chunks])
+    assert list(doc_ids) == IDS
+    np.testing.assert_allclose(weights, expected_weights(), atol=1e-15)
+
+
+def test_iter_message_topics_in_worker_processes():
+    serial = list(iter_message_topics(TOPIC_MODEL, zip(IDS, SENTENCES),
+                                      SIGNIFICANT_TERMS, chunk_size=2))
+    parallel = list(iter_message_topics(TOPIC_MODEL, zip(IDS, SENTENCES),
+                                        SIGNIFICANT_TERMS, chunk_size=2,
+                                        n_jobs=2))
+    assert len(serial) == len(parallel)
+    for (ids_s, w_s), (ids_p, w_p) in zip(serial, parallel):
+        assert list(ids_s) == list(ids_p)
+        np.testing.assert_array_equal(w_s, w_p)
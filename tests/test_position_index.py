@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import io
+
+import numpy as np
+
+from src.models.WordLevelStatistics import WordLevelStatistics
+from src.models.position_index import PositionIndex
+
+
+TEXT = ' '.join(['a b a c a b d a'] * 20)
+
+
+def test_save_over_memory_mapped_index(tmp_path):
+    path = str(tmp_path / 'text.wls')
+    wls = WordLevelStatistics(corpus_file=[io.StringIO(TEXT)])
+    wls.compute_spectra()
+    wls.save(path)
+
+    # The loaded index and spectra are mapped from the file being replaced.
+    loaded = WordLevelStatistics.load(path)
+    loaded.percentile_C = 90
+    loaded.save(path)
+    assert loaded.word_pos.positions.sum() == wls.word_pos.positions.sum()
+
+    reloaded = WordLevelStatistics.load(path)
+    assert reloaded.percentile_C == 90
+    assert reloaded.word_pos.vocab == wls.word_pos.vocab
+    for w in wls.word_pos:
+        np.testing.assert_array_equal(reloaded.word_pos[w], wls.word_pos[w])
+    np.testing.assert_array_equal(reloaded.level_stat['C'],
+                                  wls.level_stat['C'])
+    assert [f.name for f in tmp_path.iterdir()] == ['text.wls']
+
+
+def test_tokens_reused_while_iterating(monkeypatch):
+    wls = WordLevelStatistics(corpus_file=[io.StringIO(TEXT)])
+    calls = []
+    token_ids = PositionIndex.token_ids
+    monkeypatch.setattr(PositionIndex, 'token_ids',
+                        lambda self: calls.append(1) or token_ids(self))
+
+    # The keywords in context pattern of the notebooks.
+    contexts = [wls.tokens[max(n - 2, 0):n + 3]
+                for n, w in enumerate(wls.tokens) if w == 'd']
+    assert len(calls) == 1
+    assert contexts[0] == ['a', 'b', 'd', 'a', 'a']
+    assert len(contexts) == 20
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+
+import pytest
+
+from src.models import normalize
+
+sudachipy = pytest.importorskip("sudachipy")
+sudachidict_core = pytest.importorskip("sudachidict_core")
+
+TEXTS = ["東京都に行きました", "国会議事堂前駅"]
+
+
+@pytest.fixture
+def config(tmp_path):
+    # A sudachi.json naming the system dictionary, as the Makefile sets up
+    # for system_full.dic.
+    resources = os.path.join(os.path.dirname(sudachipy.__file__),
+                             "resources")
+    with open(os.path.join(resources, "sudachi.json")) as f:
+        settings = json.load(f)
+    settings["systemDict"] = os.path.join(
+        os.path.dirname(sudachidict_core.__file__), "resources", "system.dic")
+    path = tmp_path / "sudachi.json"
+    path.write_text(json.dumps(settings))
+    return str(path)
+
+
+def test_config_and_dict(config):
+    default = normalize.tokenize_many(TEXTS, lang="ja", tokenizer="sudachi")
+    assert normalize.tokenize_many(
+        TEXTS, lang="ja", tokenizer="sudachi", sudachi_config=config
+    ) == default
+    assert normalize.tokenize_many(
+        TEXTS, lang="ja", tokenizer="sudachi", sudachi_dict="core"
+    ) == default
+    assert (config, None) in normalize._SUDACHI
+    assert (None, "core") in normalize._SUDACHI
+
+    with pytest.raises(sudachipy.errors.SudachiError):
+        normalize.tokenize(TEXTS[0], lang="ja", tokenizer="sudachi",
+                           sudachi_config=config + ".missing")
+
+
+def test_config_in_cache_key(config):
+    cache = normalize.TokenCache()
+    normalize.tokenize_many(TEXTS, lang="ja", tokenizer="sudachi",
+                            cache=cache)
+    normalize.tokenize_many(TEXTS, lang="ja", tokenizer="sudachi",
+                            cache=cache, sudachi_config=config)
+    assert cache.stats["hits"] == 0
+    assert cache.stats["misses"] == 2 * len(TEXTS)
+
+
+def test_config_in_workers(config):
+    try:
+        assert normalize.tokenize_many(
+            TEXTS * 4, lang="ja", tokenizer="sudachi", workers=2,
+            batch_size=2, sudachi_config=config,
+        ) == normalize.tokenize_many(TEXTS * 4, lang="ja",
+                                     tokenizer="sudachi")
+        assert ("sudachi", 2, config, None) in normalize._WORKER_POOLS
+    finally:
+        normalize.shutdown_workers()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import random
+import re
+
+from aiohttp import web
+
+from es_standin import AnalyzeStandIn
+from src.models import normalize
+
+WORDS = ["Hello", "wörld", "😀x", "", "a&amp;b", "foo-bar", "日本語", "x"]
+
+
+def expected_tokens(s):
+    s = normalize._preprocess(s, "en", True)
+    return " ".join(w.lower() for w in re.findall(r"\w+", s))
+
+
+async def tokenize_with_stand_in(stand_in, texts, **kwargs):
+    runner = web.AppRunner(stand_in.app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    async def stream():
+        for t in texts:
+            yield t
+
+    try:
+        return [
+            t async for t in normalize.tokenize_async(
+                stream(), host="127.0.0.1", port=port, **kwargs
+            )
+        ]
+    finally:
+        await runner.cleanup()
+
+
+def test_ordered_bounded_and_retried():
+    rng = random.Random(0)
+    texts = [" ".join(rng.choices(WORDS, k=rng.randint(0, 8)))
+             for _ in range(2000)]
+    stand_in = AnalyzeStandIn(fail_every=5)
+    tokenized = asyncio.run(tokenize_with_stand_in(
+        stand_in, texts, batch_size=20, max_in_flight=4, backoff=0.001,
+        retries=5,
+    ))
+
+    assert tokenized == [expected_tokens(s) for s in texts]
+    assert 1 < stand_in.max_in_flight <= 4
+    # Every failed request was retried once by tokenize_async, and not
+    # by the transport as well.
+    assert stand_in.failures > 0
+    assert stand_in.calls == 100 + stand_in.failures